@@ -0,0 +1,218 @@
+"""Sales rollups: revenue, units and orders per day, per product and per category.
+
+The rollups are kept current by the webhook worker: when orders move to
+'Successful' (shop.webhooks), ``record_sales`` adds them in, in the same
+transaction. Sales are dated by the day the order was placed (in
+``TIME_ZONE``), so ``rebuild_sales_rollups`` can recompute exactly what
+incremental maintenance produced.
+
+Reports read the rollups only: a date range costs one row per day (and
+product or category), however many orders those days hold.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from itertools import repeat
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import DailyCategorySales, DailyProductSales, DailySales, Order, OrderItem
+from .utils import CHUNK_SIZE, chunked
+
+
+class Totals:
+    __slots__ = ('revenue', 'units', 'orders')
+
+    def __init__(self):
+        self.revenue = Decimal('0.00')
+        self.units = 0
+        self.orders = 0
+
+    def add(self, revenue, units, orders):
+        self.revenue += revenue
+        self.units += units
+        self.orders += orders
+
+    def merge(self, other):
+        self.add(other.revenue, other.units, other.orders)
+
+
+class Rollup:
+    """Totals keyed by day, (day, product_id) and (day, category)."""
+
+    def __init__(self):
+        self.source = None
+        self.days = defaultdict(Totals)
+        self.products = defaultdict(Totals)
+        self.categories = defaultdict(Totals)
+
+    def add_lines(self, lines):
+        """Fold ``(order_id, created_at, product_id, category, quantity, price)`` rows in."""
+        orders_by_category = defaultdict(set)
+        orders_by_day = defaultdict(set)
+        for order_id, created_at, product_id, category, quantity, price in lines:
+            day = timezone.localdate(created_at)
+            # An order has at most one line per product
+            self.products[day, product_id].add(price, quantity, 1)
+            self.categories[day, category].add(price, quantity, 0)
+            self.days[day].add(price, quantity, 0)
+            orders_by_category[day, category].add(order_id)
+            orders_by_day[day].add(order_id)
+        for key, order_ids in orders_by_category.items():
+            self.categories[key].orders += len(order_ids)
+        for day, order_ids in orders_by_day.items():
+            self.days[day].orders += len(order_ids)
+
+    def merge(self, other):
+        for mine, theirs in ((self.days, other.days), (self.products, other.products), (self.categories, other.categories)):
+            for key, totals in theirs.items():
+                mine[key].merge(totals)
+
+
+def order_lines(order_ids):
+    return (
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values_list('order_id', 'order__created_at', 'product_id', 'product__category', 'quantity', 'price')
+    )
+
+
+def _add(model, lookups, totals):
+    # F() deltas, so webhook workers running side by side can't lose updates
+    updated = model.objects.filter(**lookups).update(
+        revenue=F('revenue') + totals.revenue,
+        units=F('units') + totals.units,
+        orders=F('orders') + totals.orders,
+    )
+    if not updated:
+        model.objects.bulk_create([model(**lookups)], ignore_conflicts=True)
+        _add(model, lookups, totals)
+
+
+def apply_rollup(rollup):
+    """Add a rollup onto the stored tables. Must run inside a transaction."""
+    for day, totals in sorted(rollup.days.items()):
+        _add(DailySales, {'day': day}, totals)
+    for (day, product_id), totals in sorted(rollup.products.items()):
+        _add(DailyProductSales, {'day': day, 'product_id': product_id}, totals)
+    for (day, category), totals in sorted(rollup.categories.items()):
+        _add(DailyCategorySales, {'day': day, 'category': category}, totals)
+
+
+def record_sales(order_ids):
+    """Add orders that just became Successful to the rollups."""
+    rollup = Rollup()
+    for chunk in chunked(order_ids):
+        rollup.add_lines(order_lines(chunk))
+    apply_rollup(rollup)
+
+
+def rollup_orders(low, high):
+    """Rollup of the successful orders with ``low <= pk < high``."""
+    rollup = Rollup()
+    order_ids = list(
+        Order.objects.filter(status='Successful', pk__gte=low, pk__lt=high).values_list('pk', flat=True)
+    )
+    for chunk in chunked(order_ids):
+        rollup.add_lines(order_lines(chunk))
+    # What the chunk held, to tell later whether it changed
+    rollup.source = (len(order_ids), sum(order_ids))
+    return rollup
+
+
+def successful_chunks(chunk_size):
+    """``{n: (orders, sum of ids)}`` of the successful orders, chunk ``n`` holding
+    ids ``n * chunk_size`` up to ``(n + 1) * chunk_size``."""
+    return {
+        chunk: (orders, ids)
+        for chunk, orders, ids in Order.objects.filter(status='Successful')
+        .annotate(chunk=F('pk') / chunk_size)
+        .values('chunk')
+        .annotate(orders=Count('pk'), ids=Sum('pk'))
+        .order_by()
+        .values_list('chunk', 'orders', 'ids')
+    }
+
+
+def _rollup_chunk(chunk, chunk_size):
+    return rollup_orders(chunk * chunk_size, (chunk + 1) * chunk_size)
+
+
+def _rollup_chunk_in_thread(chunk, chunk_size):
+    try:
+        return _rollup_chunk(chunk, chunk_size)
+    finally:
+        # Each worker thread opened its own connection
+        connection.close()
+
+
+def lock_rollups():
+    """Keep the webhook worker from adding to the rollups until this transaction ends."""
+    if connection.vendor == 'postgresql':
+        tables = ', '.join(
+            connection.ops.quote_name(model._meta.db_table)
+            for model in (DailySales, DailyProductSales, DailyCategorySales)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {tables} IN EXCLUSIVE MODE")
+    # SQLite transactions begin IMMEDIATE (see settings): holding one
+    # already keeps every other writer out
+
+
+def rebuild_rollups(chunk_size=10000, workers=4):
+    """
+    Recompute every rollup from the successful orders.
+
+    Order id ranges of ``chunk_size`` are aggregated by ``workers`` threads
+    side by side, each on its own database connection, while the webhook
+    worker carries on. The merged result then replaces the tables in one
+    transaction that holds the worker off: in it, any chunk whose
+    successful orders changed since it was read (an order paid in the
+    meantime) is read again, so no sale recorded during the rebuild is
+    wiped by the swap.
+    """
+    parts = {}
+    chunks = sorted(successful_chunks(chunk_size))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk, part in zip(chunks, executor.map(_rollup_chunk_in_thread, chunks, repeat(chunk_size))):
+                parts[chunk] = part
+    else:
+        for chunk in chunks:
+            parts[chunk] = _rollup_chunk(chunk, chunk_size)
+
+    with transaction.atomic():
+        lock_rollups()
+        current = successful_chunks(chunk_size)
+        for chunk in set(parts) | set(current):
+            if parts.get(chunk) is None or parts[chunk].source != current.get(chunk, (0, 0)):
+                parts[chunk] = _rollup_chunk(chunk, chunk_size)
+
+        rollup = Rollup()
+        for part in parts.values():
+            rollup.merge(part)
+        DailySales.objects.all().delete()
+        DailyProductSales.objects.all().delete()
+        DailyCategorySales.objects.all().delete()
+        rows = rollup_rows(rollup)
+        for model, objects in rows.items():
+            model.objects.bulk_create(objects, batch_size=CHUNK_SIZE)
+    return rollup
+
+
+def rollup_rows(rollup):
+    def fields(totals):
+        return {'revenue': totals.revenue, 'units': totals.units, 'orders': totals.orders}
+
+    return {
+        DailySales: [DailySales(day=day, **fields(t)) for day, t in rollup.days.items()],
+        DailyProductSales: [
+            DailyProductSales(day=day, product_id=product_id, **fields(t))
+            for (day, product_id), t in rollup.products.items()
+        ],
+        DailyCategorySales: [
+            DailyCategorySales(day=day, category=category, **fields(t))
+            for (day, category), t in rollup.categories.items()
+        ],
+    }
@@ -0,0 +1,136 @@
+"""Native async versions of the cart, order and payment endpoints.
+
+These are plain Django async views, not DRF ones (DRF views are sync and
+would take a worker thread for the whole request under ASGI). Reads go
+through the async ORM; writes that need a transaction run the same
+services as the sync views via ``sync_to_async``. Payment gateway calls
+are awaited on an async HTTP client, so a slow payment provider doesn't
+hold a thread.
+
+Serializers run on the event loop, where the ORM can't be called, so
+everything they read must be loaded before serialization starts: lines
+come from ``cart_items_prefetch``/``order_items_prefetch`` and their
+products carry the ``available_stock`` annotation (see shop.inventory).
+A field that queries lazily raises SynchronousOnlyOperation here.
+"""
+import json
+from asgiref.sync import sync_to_async
+from django.db.models import aprefetch_related_objects
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from functools import wraps
+from rest_framework import exceptions
+from .authentication import CachedJWTAuthentication
+from .cart import UnknownProducts, add_to_cart
+from .checkout import EmptyCart, InsufficientStock, OrderAlreadyReserved, checkout
+from .models import Cart, Order
+from .payments import PaymentGatewayError, apayment_intent_for
+from .serializers import CartItemSerializer, CartLineSerializer, CartSerializer, OrderSerializer
+from .views import cart_items_prefetch, order_items_prefetch
+
+jwt_authentication = CachedJWTAuthentication()
+
+
+def jwt_required(view):
+    """Authenticate the request like IsAuthenticated + CachedJWTAuthentication would."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            credentials = await jwt_authentication.aauthenticate(request)
+        except exceptions.AuthenticationFailed as e:
+            return JsonResponse({"detail": e.detail}, status=401)
+        if credentials is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+        request.user, request.auth = credentials
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def json_body(request):
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+
+#----------------------------- CART ENDPOINTS-------------------------------------------
+
+@require_GET
+@jwt_required
+async def cart_detail(request):
+    cart, _ = await Cart.objects.aget_or_create(user=request.user)
+    await aprefetch_related_objects([cart], cart_items_prefetch())
+    return JsonResponse(CartSerializer(cart, context={'request': request}).data)
+
+
+@csrf_exempt
+@require_POST
+@jwt_required
+async def cart_add(request):
+    line = CartLineSerializer(data=json_body(request))
+    if not line.is_valid():
+        return JsonResponse(line.errors, status=400)
+
+    # add_to_cart is one transaction, which the async ORM can't span
+    try:
+        _, items = await sync_to_async(add_to_cart)(
+            request.user, [(line.validated_data['product_id'], line.validated_data['quantity'])]
+        )
+    except UnknownProducts:
+        return JsonResponse({"error": "No product with this id"}, status=400)
+
+    return JsonResponse(CartItemSerializer(items[0], context={'request': request}).data, status=201)
+
+#----------------------------- ORDER ENDPOINTS-------------------------------------------
+
+@csrf_exempt
+@require_POST
+@jwt_required
+async def checkout_order(request):
+    try:
+        order = await sync_to_async(checkout)(request.user)
+    except EmptyCart as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except OrderAlreadyReserved as e:
+        return JsonResponse({"error": str(e), "order_id": e.order.pk}, status=409)
+    except InsufficientStock as e:
+        return JsonResponse({"error": str(e), "product_ids": e.product_ids}, status=409)
+
+    await aprefetch_related_objects([order], order_items_prefetch())
+    return JsonResponse(OrderSerializer(order, context={'request': request}).data, status=201)
+
+
+@require_GET
+@jwt_required
+async def order_list(request):
+    orders = Order.objects.filter(user=request.user).prefetch_related(order_items_prefetch())
+    orders = [order async for order in orders]
+    return JsonResponse(OrderSerializer(orders, many=True, context={'request': request}).data, safe=False)
+
+
+@require_GET
+@jwt_required
+async def order_detail(request, pk):
+    try:
+        order = await Order.objects.prefetch_related(order_items_prefetch()).aget(user=request.user, pk=pk)
+    except Order.DoesNotExist:
+        return JsonResponse({"detail": "No Order matches the given query."}, status=404)
+    return JsonResponse(OrderSerializer(order, context={'request': request}).data)
+
+#----------------------------- PAYMENT ENDPOINTS-------------------------------------------
+
+@csrf_exempt
+@require_POST
+@jwt_required
+async def create_payment_intent(request):
+    order = await Order.objects.filter(user=request.user, status="Pending").afirst()
+    if order is None or not order.total_amount:
+        return JsonResponse({"error": "Amount is required"}, status=400)
+
+    try:
+        # The gateway call (if any) is awaited: no thread waits on the network
+        client_secret = await apayment_intent_for(order)
+    except PaymentGatewayError as e:
+        return JsonResponse({"error": str(e)}, status=502)
+
+    return JsonResponse({"clientSecret": client_secret}, status=201)
@@ -0,0 +1,131 @@
+"""JWT authentication that skips repeat work for tokens it has seen.
+
+Verified tokens are kept in a bounded in-process LRU, so a token's
+signature is checked once per process rather than once per request, and
+users are kept in the Django cache for ``AUTH_USER_CACHE_TIMEOUT``
+seconds, so authenticating costs no queries while the entry lives.
+
+Revocation is still honored: cached tokens are dropped once expired, the
+active and password-change checks run against the cached user on every
+request, and saving or deleting a user drops its cache entry (see
+shop.signals). Writes that bypass model signals, such as queryset
+updates, are picked up when the short TTL runs out; with the default
+per-process LocMem cache the same goes for other processes.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+def user_cache_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+class TokenCache:
+    """Thread-safe LRU of raw token -> validated token, bounded by
+    settings.AUTH_TOKEN_CACHE_SIZE.
+
+    Entries are keyed by the raw token, which embeds its ``jti``: looking
+    a token up by its id would mean decoding it first, which costs about
+    half as much as verifying it.
+    """
+
+    def __init__(self):
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, raw_token):
+        with self._lock:
+            token = self._tokens.get(raw_token)
+            if token is None:
+                return None
+            if token.get('exp', 0) <= time.time():
+                del self._tokens[raw_token]
+                return None
+            self._tokens.move_to_end(raw_token)
+            return token
+
+    def set(self, raw_token, token):
+        with self._lock:
+            self._tokens[raw_token] = token
+            self._tokens.move_to_end(raw_token)
+            while len(self._tokens) > settings.AUTH_TOKEN_CACHE_SIZE:
+                self._tokens.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+token_cache = TokenCache()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_validated_token(self, raw_token):
+        token = token_cache.get(raw_token)
+        if token is None:
+            token = super().get_validated_token(raw_token)
+            token_cache.set(raw_token, token)
+        return token
+
+    def get_user(self, validated_token):
+        user_id = self.get_user_id(validated_token)
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            try:
+                user = self.user_model.objects.get(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist as e:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+            cache.set(key, user, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+        return self.check_user(user, validated_token)
+
+    async def aauthenticate(self, request):
+        """authenticate() for async views: same caches, async ORM on a miss."""
+        header = self.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+
+        user_id = self.get_user_id(validated_token)
+        key = user_cache_key(user_id)
+        user = await cache.aget(key)
+        if user is None:
+            try:
+                user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+            except self.user_model.DoesNotExist as e:
+                raise AuthenticationFailed(_("User not found"), code="user_not_found") from e
+            await cache.aset(key, user, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+        return self.check_user(user, validated_token), validated_token
+
+    def get_user_id(self, validated_token):
+        try:
+            return validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+    def check_user(self, user, validated_token):
+        # The same checks JWTAuthentication.get_user makes after its query
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
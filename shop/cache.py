@@ -0,0 +1,27 @@
+from django.core.cache import cache
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # add() so concurrent first readers don't clobber a bump in flight
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """Invalidate every cached catalog page by moving to a new version."""
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 2, timeout=None)
+
+
+def catalog_cache_key(request):
+    # Pages of older versions are never deleted, they just stop being read
+    # and expire on their own. The absolute URI is used because the cached
+    # body contains absolute next/previous links.
+    return f"catalog:v{get_catalog_version()}:{request.build_absolute_uri()}"
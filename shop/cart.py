@@ -0,0 +1,120 @@
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import DecimalField, F, OuterRef, PositiveIntegerField, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .inventory import product_prefetch
+from .models import Cart, CartItem, Product
+
+
+class UnknownProducts(Exception):
+    def __init__(self, product_ids):
+        super().__init__(f"No product with id(s): {', '.join(map(str, product_ids))}")
+        self.product_ids = product_ids
+
+
+def _merge_lines(lines):
+    quantities = {}
+    for product_id, quantity in lines:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+def _upsert_quantities(cart_id, quantities):
+    table = connection.ops.quote_name(CartItem._meta.db_table)
+    rows = ', '.join(['(%s, %s, %s)'] * len(quantities))
+    params = []
+    for product_id, quantity in quantities.items():
+        params += [cart_id, product_id, quantity]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (cart_id, product_id, quantity) VALUES {rows} "
+            f"ON CONFLICT (cart_id, product_id) "
+            f"DO UPDATE SET quantity = {table}.quantity + EXCLUDED.quantity",
+            params,
+        )
+
+
+def _update_then_insert(cart_id, quantities):
+    for product_id, quantity in quantities.items():
+        updated = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).update(
+            quantity=F('quantity') + quantity
+        )
+        if not updated:
+            CartItem.objects.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+
+
+def adjust_summary(cart_id, items=0, amount=Decimal(0)):
+    """Apply a line change to the cart's item_count/subtotal and bump updated_at.
+
+    Deltas are applied by the database, like the line quantities
+    themselves, so concurrent changes to one cart add up correctly. The
+    summary never goes below zero, so a drifted cart can't fail a
+    checkout; `manage.py rebuild_cart_summaries` repairs the drift.
+    """
+    Cart.objects.filter(pk=cart_id).update(
+        item_count=Greatest(F('item_count') + items, 0),
+        subtotal=Greatest(F('subtotal') + amount, Decimal('0.00')),
+        updated_at=timezone.now(),
+    )
+
+
+def _line_totals(expression, output_field, zero):
+    """Subquery aggregating ``expression`` over the outer cart's lines."""
+    totals = (
+        CartItem.objects.filter(cart=OuterRef('pk'))
+        .order_by()
+        .values('cart')
+        .annotate(total=Sum(expression))
+        .values('total')
+    )
+    return Coalesce(Subquery(totals, output_field=output_field), Value(zero), output_field=output_field)
+
+
+def summary_expressions():
+    """item_count and subtotal as computed from the cart's lines."""
+    money = DecimalField(max_digits=10, decimal_places=2)
+    return {
+        'item_count': _line_totals(F('quantity'), PositiveIntegerField(), 0),
+        'subtotal': _line_totals(F('quantity') * F('product__price'), money, Decimal('0.00')),
+    }
+
+
+def refresh_cart_summaries(carts):
+    """Recompute the summary of every cart in ``carts`` with one UPDATE."""
+    return carts.update(**summary_expressions(), updated_at=timezone.now())
+
+
+def add_to_cart(user, lines):
+    """
+    Add ``(product_id, quantity)`` lines to the user's cart in one transaction.
+
+    Quantities are incremented by the database, so concurrent adds for the
+    same line never lose updates. Returns the cart and the affected items.
+    """
+    quantities = _merge_lines(lines)
+    with transaction.atomic():
+        cart, _ = Cart.objects.get_or_create(user=user)
+
+        prices = dict(Product.objects.filter(id__in=quantities).values_list('id', 'price'))
+        missing = sorted(set(quantities) - set(prices))
+        if missing:
+            raise UnknownProducts(missing)
+
+        if connection.features.supports_update_conflicts_with_target:
+            _upsert_quantities(cart.id, quantities)
+        else:
+            _update_then_insert(cart.id, quantities)
+
+        adjust_summary(
+            cart.id,
+            items=sum(quantities.values()),
+            amount=sum(prices[product_id] * quantity for product_id, quantity in quantities.items()),
+        )
+
+        items = list(
+            CartItem.objects.filter(cart=cart, product_id__in=quantities).prefetch_related(product_prefetch())
+        )
+    return cart, items
@@ -0,0 +1,153 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import inventory
+from .cache import bump_catalog_version
+from .cart import adjust_summary
+from .models import CartItem, Order, OrderItem
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class EmptyCart(CheckoutError):
+    def __init__(self):
+        super().__init__("Cart is empty")
+
+
+class OrderAlreadyReserved(CheckoutError):
+    def __init__(self, order):
+        super().__init__(f"Order {order.pk} is already checked out and awaiting payment")
+        self.order = order
+
+
+class InsufficientStock(CheckoutError):
+    def __init__(self, product_ids):
+        super().__init__(f"Insufficient stock for product id(s): {', '.join(map(str, product_ids))}")
+        self.product_ids = product_ids
+
+
+def reserve_stock(quantities):
+    """
+    Decrement stock for ``{product_id: quantity}`` or raise InsufficientStock.
+
+    Each product (or stock shard, for hot products) is a conditional
+    UPDATE that only succeeds while enough stock is left, so concurrent
+    checkouts can never oversell; see shop.inventory. Must run inside a
+    transaction so a partial reservation is rolled back.
+    """
+    short = inventory.take(quantities)
+    if short:
+        raise InsufficientStock(short)
+
+
+def release_stock(order):
+    """Return a reserved order's quantities to stock."""
+    with transaction.atomic():
+        released = Order.objects.filter(pk=order.pk, reserved_at__isnull=False).update(
+            reserved_at=None, updated_at=timezone.now()
+        )
+        if not released:
+            return
+        inventory.give_back(dict(order.orderitem_set.values_list('product_id', 'quantity')))
+        transaction.on_commit(bump_catalog_version)
+    order.reserved_at = None
+
+
+def release_orders(order_ids):
+    """
+    Return the stock held by the given reserved orders, one UPDATE per
+    product, and clear their reservations. Must run inside a transaction,
+    with the orders locked by the caller.
+    """
+    quantities = (
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values('product_id')
+        .annotate(quantity=Sum('quantity'))
+        .values_list('product_id', 'quantity')
+    )
+    inventory.give_back(dict(quantities))
+    Order.objects.filter(pk__in=order_ids).update(reserved_at=None, updated_at=timezone.now())
+    transaction.on_commit(bump_catalog_version)
+
+
+def reserve_orders(order_ids):
+    """
+    Take stock again for orders whose reservation was given back, one order
+    at a time; returns the ids of those there was too little stock for,
+    which are flagged ``backordered``. Must run inside a transaction, with
+    the orders locked by the caller.
+    """
+    lines = defaultdict(dict)
+    for order_id, product_id, quantity in OrderItem.objects.filter(order_id__in=order_ids).values_list(
+        'order_id', 'product_id', 'quantity'
+    ):
+        lines[order_id][product_id] = quantity
+
+    reserved, short = [], []
+    for order_id in order_ids:
+        try:
+            # A savepoint each, so one short order doesn't undo the others
+            with transaction.atomic():
+                reserve_stock(lines[order_id])
+        except InsufficientStock:
+            short.append(order_id)
+        else:
+            reserved.append(order_id)
+
+    now = timezone.now()
+    Order.objects.filter(pk__in=reserved).update(reserved_at=now, updated_at=now)
+    Order.objects.filter(pk__in=short).update(backordered=True, updated_at=now)
+    transaction.on_commit(bump_catalog_version)
+    return short
+
+
+def checkout(user):
+    """
+    Turn the user's cart into their pending order and reserve its stock.
+
+    Everything happens in one transaction: the order lines are replaced by
+    the cart contents with a single bulk insert, stock is reserved and the
+    cart is emptied. Any failure leaves cart, order and stock untouched.
+    """
+    with transaction.atomic():
+        lines = list(
+            CartItem.objects.filter(cart__user=user, quantity__gt=0).select_related('product')
+        )
+        if not lines:
+            raise EmptyCart()
+
+        order, _ = Order.objects.select_for_update().get_or_create(user=user, status="Pending")
+        if order.reserved_at:
+            raise OrderAlreadyReserved(order)
+
+        reserve_stock({line.product_id: line.quantity for line in lines})
+
+        order.orderitem_set.all().delete()
+        items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product=line.product,
+                quantity=line.quantity,
+                price=line.product.price * line.quantity,
+            )
+            for line in lines
+        ])
+
+        order.total_amount = sum(item.price for item in items)
+        order.reserved_at = timezone.now()
+        order.save(update_fields=['total_amount', 'reserved_at', 'updated_at'])
+
+        CartItem.objects.filter(pk__in=[line.pk for line in lines]).delete()
+        adjust_summary(
+            lines[0].cart_id,
+            items=-sum(line.quantity for line in lines),
+            amount=-sum(line.quantity * line.product.price for line in lines),
+        )
+        # Cached catalog pages carry stock levels
+        transaction.on_commit(bump_catalog_version)
+    return order
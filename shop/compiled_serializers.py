@@ -0,0 +1,154 @@
+"""A faster ``many=True`` path for read-only serializers.
+
+DRF serializes a list by calling each field's ``get_attribute`` and
+``to_representation`` per row, which for big catalog and order pages
+costs more than the queries did. CompiledListSerializer looks at the child
+serializer's fields once per response and turns each into a plain
+(getter, converter) pair: attribute getters for model fields, and inline
+conversions for the field types these serializers use (integers, strings,
+booleans, decimals, datetimes, primary keys and nested serializers).
+Any other field keeps its own ``to_representation``, so output is always
+exactly what DRF would produce; tests compare the rendered bytes.
+
+Use it with ``Meta.list_serializer_class = CompiledListSerializer``.
+Writes (``create``/``update``) go through DRF unchanged.
+"""
+import decimal
+from operator import attrgetter
+
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import models
+from rest_framework import fields, relations, serializers
+from rest_framework.fields import SkipField
+from rest_framework.settings import api_settings
+
+
+def _decimal(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.normalize_output or field.decimal_places is None:
+        return field.to_representation
+
+    exponent = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    def convert(value):
+        if not isinstance(value, decimal.Decimal):
+            value = decimal.Decimal(str(value).strip())
+        return f'{value.quantize(exponent, rounding=rounding, context=context):f}'
+    return convert
+
+
+def _datetime(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+    if output_format is None or output_format.lower() != fields.ISO_8601 or field_timezone is None:
+        return field.to_representation
+
+    def convert(value):
+        if not value:
+            return None
+        if isinstance(value, str) or value.tzinfo is None:
+            return field.to_representation(value)
+        value = value.astimezone(field_timezone).isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return convert
+
+
+def _converter(field):
+    if isinstance(field, serializers.ListSerializer):
+        child = compile_serializer(field.child)
+
+        def convert(value):
+            iterable = value.all() if isinstance(value, models.manager.BaseManager) else value
+            return [child(item) for item in iterable]
+        return convert
+    if isinstance(field, serializers.Serializer):
+        return compile_serializer(field)
+    if type(field) is fields.IntegerField:
+        return int
+    if type(field) is fields.CharField:
+        return str
+    if type(field) is fields.BooleanField:
+        return bool
+    if type(field) is fields.DecimalField:
+        return _decimal(field)
+    if type(field) is fields.DateTimeField:
+        return _datetime(field)
+    return field.to_representation
+
+
+def _compile_field(field, model):
+    """(getter, converter) for one readable field; a converter of None passes the value through."""
+    if isinstance(field, serializers.SerializerMethodField) or field.source == '*' or len(field.source_attrs) != 1:
+        return field.get_attribute, _converter(field)
+
+    source = field.source_attrs[0]
+    try:
+        model_field = model._meta.get_field(source) if model is not None else None
+    except FieldDoesNotExist:
+        model_field = None
+
+    if (
+        type(field).get_attribute is not fields.Field.get_attribute
+        and not isinstance(field, relations.PrimaryKeyRelatedField)
+    ):
+        # The field looks its own value up (e.g. stock with shards added in)
+        return field.get_attribute, _converter(field)
+    if model_field is None:
+        # Reverse relations (``orderitem_set``) are plain attributes; leave
+        # properties and methods to DRF, which calls them
+        if isinstance(field, serializers.ListSerializer):
+            return attrgetter(source), _converter(field)
+        return field.get_attribute, _converter(field)
+    if not model_field.concrete:
+        return field.get_attribute, _converter(field)
+    if (
+        isinstance(field, relations.PrimaryKeyRelatedField)
+        and field.pk_field is None
+        and field.use_pk_only_optimization()
+    ):
+        # The raw foreign key column is what DRF ends up rendering
+        return attrgetter(model_field.attname), None
+    return attrgetter(source), _converter(field)
+
+
+def compile_serializer(serializer):
+    """Return ``instance -> dict``, equivalent to ``serializer.to_representation``.
+
+    ``serializer`` must be bound (its fields carry the response's context).
+    """
+    if type(serializer).to_representation is not serializers.Serializer.to_representation:
+        return serializer.to_representation
+
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    plan = [(field.field_name, *_compile_field(field, model)) for field in serializer._readable_fields]
+
+    def to_representation(instance):
+        ret = {}
+        for name, get, convert in plan:
+            try:
+                value = get(instance)
+            except SkipField:
+                continue
+            except ObjectDoesNotExist:
+                value = None
+            if value is None:
+                ret[name] = None
+            elif convert is None:
+                ret[name] = value
+            else:
+                ret[name] = convert(value)
+        return ret
+    return to_representation
+
+
+class CompiledListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        child = compile_serializer(self.child)
+        return [child(item) for item in iterable]
@@ -0,0 +1,52 @@
+import hashlib
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def make_etag(*parts):
+    """Strong ETag over the given version markers."""
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def items_version(queryset):
+    """
+    Version markers for a set of cart/order lines and their products.
+
+    One aggregate query: the line count, the newest product change and
+    the products' shard total, so nested product data going stale changes
+    the ETag too (shard moves leave ``updated_at`` alone; see
+    shop.inventory).
+    """
+    row = queryset.aggregate(
+        lines=Count('pk', distinct=True),
+        products_updated=Max('product__updated_at'),
+        shard_stock=Sum('product__stock_shards__quantity'),
+    )
+    return row['lines'], row['shard_stock'], row['products_updated']
+
+
+class ConditionalGetMixin:
+    """
+    Answer If-None-Match / If-Modified-Since with 304 before serializing.
+
+    Views implement ``get_validators()`` returning ``(etag, last_modified)``
+    from as little data as possible.
+    """
+
+    def get_validators(self):
+        raise NotImplementedError
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified.timestamp() if last_modified else None
+        )
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
@@ -0,0 +1,37 @@
+import csv
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from .serializers import OrderSerializer
+
+CSV_COLUMNS = [
+    'order_id', 'created_at', 'status', 'total_amount',
+    'product_id', 'product_name', 'quantity', 'price',
+]
+
+
+class Echo:
+    """File-like object whose write() just hands the line back to csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def ndjson_lines(orders, context):
+    for order in orders:
+        data = OrderSerializer(order, context=context).data
+        yield json.dumps(data, cls=JSONEncoder) + '\n'
+
+
+def csv_lines(orders):
+    """One row per order line; orders without lines get a single row."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for order in orders:
+        head = [order.pk, order.created_at.isoformat(), order.status, order.total_amount]
+        items = order.orderitem_set.all()
+        if not items:
+            yield writer.writerow(head + [''] * 4)
+        for item in items:
+            yield writer.writerow(head + [item.product_id, item.product.name, item.quantity, item.price])
@@ -0,0 +1,145 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# name -> (box, mode). 'fit' crops to exactly the box, 'contain' only
+# shrinks to fit inside it.
+DERIVATIVES = {
+    'thumbnail': ((150, 150), 'fit'),
+    'card': ((400, 400), 'fit'),
+    'large': ((1200, 1200), 'contain'),
+}
+
+FORMATS = {
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+
+
+def render_derivatives(data):
+    """
+    Render every derivative of one source image.
+
+    Pure Pillow with no Django access, so it can run in a worker process.
+    Returns ``{(name, format): bytes}``.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        source = ImageOps.exif_transpose(source)
+        source.load()
+
+    rendered = {}
+    for name, (box, mode) in DERIVATIVES.items():
+        if mode == 'fit':
+            image = ImageOps.fit(source, box, Image.Resampling.LANCZOS)
+        else:
+            image = source.copy()
+            image.thumbnail(box, Image.Resampling.LANCZOS)
+
+        for fmt, (pil_format, options) in FORMATS.items():
+            out = image
+            if pil_format == 'JPEG' and out.mode != 'RGB':
+                # JPEG has no alpha: flatten onto white
+                background = Image.new('RGB', out.size, 'white')
+                converted = out.convert('RGBA')
+                background.paste(converted, mask=converted.getchannel('A'))
+                out = background
+            buffer = io.BytesIO()
+            out.save(buffer, pil_format, **options)
+            rendered[(name, fmt)] = buffer.getvalue()
+    return rendered
+
+
+def derivative_path(image_name, name, fmt):
+    stem = os.path.splitext(image_name)[0]
+    return f"derivatives/{stem}/{name}.{'jpg' if fmt == 'jpeg' else fmt}"
+
+
+def store_derivatives(product_id, image_name, rendered):
+    """Save rendered files and record them on the product, if its image is unchanged."""
+    from .cache import bump_catalog_version
+    from .models import Product
+
+    derivatives = {'source': image_name}
+    for (name, fmt), data in rendered.items():
+        path = derivative_path(image_name, name, fmt)
+        # Paths are deterministic, so a regeneration replaces the old file
+        if default_storage.exists(path):
+            default_storage.delete(path)
+        derivatives.setdefault(name, {})[fmt] = default_storage.save(path, ContentFile(data))
+
+    updated = Product.objects.filter(pk=product_id, image=image_name).update(
+        image_derivatives=derivatives, updated_at=timezone.now()
+    )
+    if updated:
+        # update() sends no signals: cached catalog pages carry the derivatives
+        transaction.on_commit(bump_catalog_version)
+    return derivatives
+
+
+def read_source(image_name):
+    try:
+        with default_storage.open(image_name, 'rb') as f:
+            return f.read()
+    except (FileNotFoundError, OSError):
+        logger.warning("Image %s is missing, no derivatives generated", image_name)
+        return None
+
+
+def needs_derivatives(product):
+    return bool(product.image) and product.image_derivatives.get('source') != product.image.name
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the web process is multi-threaded
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+                mp_context=get_context('spawn'),
+            )
+        return _pool
+
+
+def schedule_derivatives(product):
+    """
+    Generate derivatives for ``product.image`` in the background pool.
+
+    Rendering runs in a worker process; storing the files and updating the
+    row happens in the pool's callback thread. With
+    IMAGE_DERIVATIVES_ASYNC off everything runs inline.
+    """
+    image_name = product.image.name
+    data = read_source(image_name)
+    if data is None:
+        return
+
+    if not settings.IMAGE_DERIVATIVES_ASYNC:
+        store_derivatives(product.pk, image_name, render_derivatives(data))
+        return
+
+    def done(future):
+        try:
+            store_derivatives(product.pk, image_name, future.result())
+        except Exception:
+            logger.exception("Generating derivatives for %s failed", image_name)
+        finally:
+            close_old_connections()
+
+    get_pool().submit(render_derivatives, data).add_done_callback(done)
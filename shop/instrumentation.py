@@ -0,0 +1,67 @@
+import threading
+from bisect import bisect_left
+
+# Upper bounds (ms) of the latency histogram buckets; the last is open ended.
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.duplicate_queries = 0
+        self.sql_ms = 0.0
+        self.view_ms = 0.0
+        self.render_ms = 0.0
+        self.total_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, sample):
+        self.requests += 1
+        self.queries += sample['queries']
+        self.max_queries = max(self.max_queries, sample['queries'])
+        self.duplicate_queries += sample['duplicate_queries']
+        self.sql_ms += sample['sql_ms']
+        self.view_ms += sample['view_ms']
+        self.render_ms += sample['render_ms']
+        self.total_ms += sample['total_ms']
+        self.histogram[bisect_left(LATENCY_BUCKETS_MS, sample['total_ms'])] += 1
+
+    def as_dict(self):
+        n = self.requests or 1
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            'requests': self.requests,
+            'avg_queries': round(self.queries / n, 2),
+            'max_queries': self.max_queries,
+            'duplicate_queries': self.duplicate_queries,
+            'avg_sql_ms': round(self.sql_ms / n, 3),
+            'avg_view_ms': round(self.view_ms / n, 3),
+            'avg_render_ms': round(self.render_ms / n, 3),
+            'avg_total_ms': round(self.total_ms / n, 3),
+            'latency_histogram_ms': dict(zip(labels, self.histogram)),
+        }
+
+
+class Registry:
+    """Per-process aggregate of instrumented requests, keyed by route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, sample):
+        with self._lock:
+            self._routes.setdefault(route, RouteStats()).add(sample)
+
+    def snapshot(self):
+        with self._lock:
+            return {route: stats.as_dict() for route, stats in sorted(self._routes.items())}
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+registry = Registry()
@@ -0,0 +1,174 @@
+"""Stock counters that stay correct, and fast, under flash-sale load.
+
+Every decrement is a conditional UPDATE (``... WHERE quantity >= n``), so
+stock can never go below zero whatever the concurrency, and there's no
+read-then-write window to lose updates in.
+
+A product's stock normally lives in ``Product.stock``, and then every
+buyer of that product queues on the same row lock. ``shard_stock`` moves
+a hot product's stock into N StockShard rows instead. A buyer then takes
+from one shard picked at random, so N buyers can hold locks at once. Only
+when no single shard can cover an order are the shards locked together,
+in shard order, and drained one after another, ``Product.stock`` last.
+
+A product's availability is always its ``stock`` plus its shards, so
+stock written to a sharded product's row (the Django admin, bulk
+imports) is still sold, just without the spread. The API reports and
+sets the total: querysets it serializes annotate it (``with_available_stock``)
+and writes go through ``set_stock``. All functions that change stock must
+run inside a transaction.
+"""
+import random
+
+from django.db import transaction
+from django.db.models import F, IntegerField, OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .cache import bump_catalog_version
+from .models import Product, StockShard
+
+
+def shard_counts(product_ids):
+    """``{product_id: shards}`` for those of the products that are sharded."""
+    return dict(
+        Product.objects.filter(pk__in=product_ids, stock_shard_count__gt=0)
+        .values_list('pk', 'stock_shard_count')
+    )
+
+
+def _take_from_product(product_id, quantity):
+    return Product.objects.filter(pk=product_id, stock__gte=quantity).update(
+        stock=F('stock') - quantity, updated_at=timezone.now()
+    )
+
+
+def _take_from_shards(product_id, quantity, shards):
+    start = random.randrange(shards)
+    for offset in range(shards):
+        shard = (start + offset) % shards
+        if StockShard.objects.filter(product_id=product_id, shard=shard, quantity__gte=quantity).update(
+            quantity=F('quantity') - quantity
+        ):
+            return True
+
+    # No shard covers it alone: lock them all (in order, so this can't
+    # deadlock with another spill) and drain them one after another, then
+    # whatever stock sits in the product row
+    rows = list(
+        StockShard.objects.select_for_update()
+        .filter(product_id=product_id)
+        .order_by('shard')
+        .values_list('pk', 'quantity')
+    )
+    stock = Product.objects.select_for_update().filter(pk=product_id).values_list('stock', flat=True).first() or 0
+    if sum(available for _, available in rows) + stock < quantity:
+        return False
+    remaining = quantity
+    for pk, available in rows:
+        taken = min(available, remaining)
+        if taken:
+            StockShard.objects.filter(pk=pk).update(quantity=F('quantity') - taken)
+            remaining -= taken
+        if not remaining:
+            break
+    if remaining:
+        _take_from_product(product_id, remaining)
+    return True
+
+
+def take(quantities):
+    """
+    Decrement stock for ``{product_id: quantity}``; returns the product ids
+    that are short (and were not decremented).
+
+    Products are visited in id order so two orders sharing products can't
+    deadlock. Callers roll the transaction back when anything is short.
+    """
+    shards = shard_counts(quantities)
+    short = []
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        if product_id in shards:
+            taken = _take_from_shards(product_id, quantity, shards[product_id])
+        else:
+            taken = _take_from_product(product_id, quantity)
+        if not taken:
+            short.append(product_id)
+    return short
+
+
+def give_back(quantities):
+    """Return ``{product_id: quantity}`` to stock (a random shard when sharded)."""
+    shards = shard_counts(quantities)
+    now = timezone.now()
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        if product_id in shards:
+            StockShard.objects.filter(product_id=product_id, shard=random.randrange(shards[product_id])).update(
+                quantity=F('quantity') + quantity
+            )
+        else:
+            Product.objects.filter(pk=product_id).update(stock=F('stock') + quantity, updated_at=now)
+
+
+def available_stock():
+    """Expression for a product's units available, shards included."""
+    shard_total = (
+        StockShard.objects.filter(product_id=OuterRef('pk'))
+        .values('product_id')
+        .annotate(total=Sum('quantity'))
+        .values('total')
+    )
+    return F('stock') + Coalesce(Subquery(shard_total), 0, output_field=IntegerField())
+
+
+def with_available_stock(queryset=None):
+    """Products annotated with ``available_stock``, which the API reports as their stock."""
+    if queryset is None:
+        queryset = Product.objects.all()
+    return queryset.annotate(available_stock=available_stock())
+
+
+def product_prefetch(lookup='product'):
+    """Prefetch a line's product with ``available_stock`` annotated."""
+    return Prefetch(lookup, queryset=with_available_stock())
+
+
+def available(product_ids):
+    """``{product_id: units available}``, shards included, in one query."""
+    return dict(
+        Product.objects.filter(pk__in=product_ids)
+        .annotate(available=available_stock())
+        .values_list('pk', 'available')
+    )
+
+
+def shard_stock(product_id, shards, total=None):
+    """
+    Spread a product's whole stock evenly over ``shards`` shards (0 folds
+    them back); returns the total. ``total`` replaces the stock first.
+    """
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product_id)
+        existing = StockShard.objects.select_for_update().filter(product=product)
+        if total is None:
+            total = product.stock + sum(existing.values_list('quantity', flat=True))
+        existing.delete()
+
+        share, extra = divmod(total, shards) if shards else (0, 0)
+        StockShard.objects.bulk_create([
+            StockShard(product=product, shard=shard, quantity=share + (shard < extra))
+            for shard in range(shards)
+        ])
+        Product.objects.filter(pk=product_id).update(
+            stock=0 if shards else total, stock_shard_count=shards, updated_at=timezone.now()
+        )
+        transaction.on_commit(bump_catalog_version)
+    return total
+
+
+def set_stock(product_id, total):
+    """Set a product's availability to ``total``, keeping its shards if it has any."""
+    shards = shard_counts([product_id]).get(product_id, 0)
+    return shard_stock(product_id, shards, total=total)
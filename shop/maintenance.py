@@ -0,0 +1,141 @@
+"""Housekeeping for carts and pending orders nobody is coming back to.
+
+Abandoned carts (untouched for ``CART_RETENTION_DAYS``) are deleted with
+their items; a user who returns simply gets a new, empty cart. Stale
+pending orders (untouched for ``PENDING_ORDER_RETENTION_HOURS``) give back
+any stock reserved at checkout. Orders that never reached the payment
+gateway are deleted. Orders with a payment on record become 'Failed', so
+a late webhook for them still applies; if it's a success, the webhook
+worker takes the stock again (see shop.webhooks). Failed orders still
+holding stock past the same cutoff give it back too.
+
+Work is done in batches of ``MAINTENANCE_BATCH_SIZE`` rows, each in its
+own short transaction, walking the table in primary key order. A run
+that is interrupted leaves nothing half done, and the next run picks up
+whatever is still stale. At most ``MAINTENANCE_MAX_RATE`` rows are
+removed per second, so a large backlog doesn't starve live traffic of
+database writes.
+
+Call ``run_maintenance()`` from a scheduler (cron, a worker beat), or
+run ``manage.py sweep_abandoned``.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .checkout import release_orders
+from .models import Cart, Order, Payment
+
+
+class SweepResult:
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.name}: {self.rows} rows in {self.batches} batches, {self.seconds:.2f}s ({self.rate:.0f} rows/s)"
+
+
+class Throttle:
+    """Sleeps between batches so no more than ``max_rate`` rows go per second."""
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+
+    def wait(self, rows, elapsed):
+        if self.max_rate and rows:
+            time.sleep(max(0.0, rows / self.max_rate - elapsed))
+
+
+def _sweep(name, sweep_batch, batch_size, throttle):
+    result = SweepResult(name)
+    start = time.monotonic()
+    after = 0
+    while True:
+        batch_start = time.monotonic()
+        rows, after = sweep_batch(after, batch_size)
+        if after is None:
+            break
+        result.rows += rows
+        result.batches += 1
+        throttle.wait(rows, time.monotonic() - batch_start)
+    result.seconds = time.monotonic() - start
+    return result
+
+
+def expire_carts_batch(cutoff, after, batch_size):
+    """Delete one batch of carts idle since ``cutoff``; returns (rows, last pk)."""
+    with transaction.atomic():
+        ids = list(
+            Cart.objects.filter(pk__gt=after, updated_at__lt=cutoff)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0, None
+        # Re-check the cutoff: a cart written to since the select is live again
+        _, deleted = Cart.objects.filter(pk__in=ids, updated_at__lt=cutoff).delete()
+    return deleted.get(Cart._meta.label, 0), ids[-1]
+
+
+def expire_orders_batch(cutoff, after, batch_size):
+    """Expire one batch of orders idle since ``cutoff``; returns (rows, last pk)."""
+    with transaction.atomic():
+        orders = list(
+            Order.objects.select_for_update()
+            .filter(
+                Q(status='Pending') | Q(status='Failed', reserved_at__isnull=False),
+                pk__gt=after, updated_at__lt=cutoff,
+            )
+            .order_by('pk')
+            .values_list('pk', 'status', 'reserved_at')[:batch_size]
+        )
+        if not orders:
+            return 0, None
+        reserved = [pk for pk, _, reserved_at in orders if reserved_at]
+        if reserved:
+            release_orders(reserved)
+
+        pending = [pk for pk, status, _ in orders if status == 'Pending']
+        paid = set(Payment.objects.filter(order_id__in=pending).values_list('order_id', flat=True))
+        Order.objects.filter(pk__in=paid).update(status='Failed', updated_at=timezone.now())
+        Order.objects.filter(pk__in=[pk for pk in pending if pk not in paid]).delete()
+    return len(orders), orders[-1][0]
+
+
+def expire_carts(cutoff=None, batch_size=None, max_rate=None):
+    cutoff = cutoff or timezone.now() - timedelta(days=settings.CART_RETENTION_DAYS)
+    return _sweep(
+        'carts',
+        lambda after, size: expire_carts_batch(cutoff, after, size),
+        batch_size or settings.MAINTENANCE_BATCH_SIZE,
+        Throttle(settings.MAINTENANCE_MAX_RATE if max_rate is None else max_rate),
+    )
+
+
+def expire_pending_orders(cutoff=None, batch_size=None, max_rate=None):
+    cutoff = cutoff or timezone.now() - timedelta(hours=settings.PENDING_ORDER_RETENTION_HOURS)
+    return _sweep(
+        'pending orders',
+        lambda after, size: expire_orders_batch(cutoff, after, size),
+        batch_size or settings.MAINTENANCE_BATCH_SIZE,
+        Throttle(settings.MAINTENANCE_MAX_RATE if max_rate is None else max_rate),
+    )
+
+
+def run_maintenance(batch_size=None, max_rate=None):
+    """Run every sweep once; the entry point for schedulers."""
+    return [
+        expire_pending_orders(batch_size=batch_size, max_rate=max_rate),
+        expire_carts(batch_size=batch_size, max_rate=max_rate),
+    ]
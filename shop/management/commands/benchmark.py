@@ -0,0 +1,360 @@
+import asyncio
+import json
+import logging
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from asgiref.sync import sync_to_async
+from django.test import AsyncClient, Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from shop.management.testdb import throwaway_test_database
+from shop.models import Cart, CartItem, Order, OrderItem, Product
+from shop.payment_stub import make_server
+
+User = get_user_model()
+
+
+class Scenario:
+    """Seeded ids the request builders pick from."""
+
+    def __init__(self, product_ids, users, order_ids_by_user):
+        self.product_ids = product_ids
+        self.users = users
+        self.order_ids_by_user = order_ids_by_user
+        # Users with an order to fetch; order detail requests pick from these
+        self.buyers = [user for user in users if user.pk in order_ids_by_user]
+
+
+# (name, default weight, builder). A builder returns
+# (method, path, json body or None, user or None) for one request.
+ENDPOINTS = [
+    ('products', 30, lambda s, r: ('get', reverse('products'), None, None)),
+    ('product_detail', 20, lambda s, r: (
+        'get', reverse('product_detail', args=[r.choice(s.product_ids)]), None, None)),
+    ('product_search', 10, lambda s, r: (
+        'get', f"{reverse('product_search')}?q=product+{r.randrange(len(s.product_ids))}", None, None)),
+    ('cart_detail', 15, lambda s, r: ('get', reverse('cart_detail'), None, r.choice(s.users))),
+    ('add_item', 10, lambda s, r: (
+        'post', reverse('add_item'), {'product_id': r.choice(s.product_ids), 'quantity': 1}, r.choice(s.users))),
+    ('add_items', 5, lambda s, r: (
+        'post', reverse('add_items'),
+        {'items': [{'product_id': pid, 'quantity': 1} for pid in r.sample(s.product_ids, min(3, len(s.product_ids)))]},
+        r.choice(s.users))),
+    ('orders', 10, lambda s, r: ('get', reverse('orders'), None, r.choice(s.users))),
+    ('order_detail', 5, lambda s, r: _order_detail(s, r)),
+    ('make_order', 3, lambda s, r: (
+        'post', reverse('make_order'), {'product_id': r.choice(s.product_ids)}, r.choice(s.users))),
+    ('checkout', 2, lambda s, r: ('post', reverse('checkout'), None, r.choice(s.users))),
+    # Off by default; payment endpoints talk to a local stub (--payment-latency)
+    ('payment_intent', 0, lambda s, r: ('post', reverse('create-payment-intent'), None, r.choice(s.users))),
+    ('async_cart_detail', 0, lambda s, r: ('get', reverse('async_cart_detail'), None, r.choice(s.users))),
+    ('async_add_item', 0, lambda s, r: (
+        'post', reverse('async_add_item'), {'product_id': r.choice(s.product_ids), 'quantity': 1},
+        r.choice(s.users))),
+    ('async_orders', 0, lambda s, r: ('get', reverse('async_orders'), None, r.choice(s.users))),
+    ('async_order_detail', 0, lambda s, r: _order_detail(s, r, 'async_order_detail')),
+    ('async_checkout', 0, lambda s, r: ('post', reverse('async_checkout'), None, r.choice(s.users))),
+    ('async_payment_intent', 0, lambda s, r: (
+        'post', reverse('async_create_payment_intent'), None, r.choice(s.users))),
+]
+
+PAYMENT_ENDPOINTS = {'payment_intent', 'async_payment_intent'}
+ORDER_DETAIL_ENDPOINTS = {'order_detail', 'async_order_detail'}
+
+
+def _order_detail(scenario, rng, url_name='order_detail'):
+    user = rng.choice(scenario.buyers)
+    order_id = rng.choice(scenario.order_ids_by_user[user.pk])
+    return 'get', reverse(url_name, args=[order_id]), None, user
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(sample['ms'] for sample in samples)
+    # None when queries weren't captured (--asgi)
+    queries = [sample['queries'] for sample in samples if sample['queries'] is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample['status'] >= 500),
+        'rps': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway database at the given scale and replay a weighted mix "
+        "of the API endpoints against the in-process WSGI (or, with --asgi, ASGI) app."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--orders-per-user', type=int, default=5)
+        parser.add_argument('--items-per-order', type=int, default=3)
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument(
+            '--mix', default='',
+            help="Override weights, e.g. 'products=50,checkout=0'. Endpoints: "
+                 + ', '.join(name for name, _, _ in ENDPOINTS),
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--asgi', action='store_true',
+            help="Replay through the ASGI handler with up to --concurrency requests in flight "
+                 "on one event loop, instead of WSGI worker threads. Queries aren't counted.",
+        )
+        parser.add_argument(
+            '--payment-latency', type=float, default=200,
+            help="Milliseconds the stub payment API waits per PaymentIntent.",
+        )
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        for name in ('products', 'users'):
+            if options[name] < 1:
+                raise CommandError(f"--{name} must be at least 1")
+        weights = self.parse_mix(options['mix'])
+        rng = random.Random(options['seed'])
+
+        with throwaway_test_database('benchmark'):
+            # Failed requests are counted in the report rather than logged one by one
+            request_logger = logging.getLogger('django.request')
+            old_level = request_logger.level
+            request_logger.setLevel(logging.CRITICAL)
+            try:
+                started = time.perf_counter()
+                scenario = self.seed(options, rng)
+                self.stdout.write(f"Seeded in {time.perf_counter() - started:.1f}s")
+                stub = None
+                if any(weights[name] for name in PAYMENT_ENDPOINTS):
+                    stub = self.start_payment_stub(options['payment_latency'])
+                try:
+                    results = self.run(scenario, weights, options, rng)
+                finally:
+                    if stub:
+                        self.stop_payment_stub(stub)
+            finally:
+                request_logger.setLevel(old_level)
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def parse_mix(self, mix):
+        weights = {name: weight for name, weight, _ in ENDPOINTS}
+        for part in filter(None, mix.split(',')):
+            name, _, weight = part.partition('=')
+            if name not in weights:
+                raise CommandError(f"Unknown endpoint in --mix: {name}")
+            weights[name] = int(weight)
+        if not any(weights.values()):
+            raise CommandError("--mix leaves nothing to run")
+        return weights
+
+    def seed(self, options, rng):
+        categories = [f"category-{i}" for i in range(20)]
+        Product.objects.bulk_create([
+            Product(
+                name=f"Product {i}",
+                description=f"Synthetic product {i}",
+                price=Decimal(rng.randint(100, 50000)) / 100,
+                stock=1_000_000,
+                category=rng.choice(categories),
+                image=f"products/{i}.png",
+            )
+            for i in range(options['products'])
+        ], batch_size=1000)
+        products = list(Product.objects.only('id', 'price'))
+
+        User.objects.bulk_create([
+            User(username=f"bench-{i}", email=f"bench-{i}@example.com", password='!')
+            for i in range(options['users'])
+        ], batch_size=1000)
+        users = list(User.objects.filter(username__startswith='bench-'))
+
+        carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+        CartItem.objects.bulk_create([
+            CartItem(cart=cart, product=product, quantity=rng.randint(1, 3))
+            for cart in carts
+            for product in rng.sample(products, min(3, len(products)))
+        ], batch_size=1000)
+
+        orders = Order.objects.bulk_create([
+            Order(user=user, status=rng.choice(['Successful', 'Failed']))
+            for user in users
+            for _ in range(options['orders_per_user'])
+        ], batch_size=1000)
+        # Plus the pending order each user is about to pay for
+        orders += Order.objects.bulk_create([Order(user=user) for user in users], batch_size=1000)
+        items = []
+        for order in orders:
+            for product in rng.sample(products, min(options['items_per_order'], len(products))):
+                quantity = rng.randint(1, 3)
+                items.append(OrderItem(order=order, product=product, quantity=quantity, price=product.price * quantity))
+                order.total_amount = Decimal(order.total_amount) + product.price * quantity
+        OrderItem.objects.bulk_create(items, batch_size=1000)
+        Order.objects.bulk_update(orders, ['total_amount'], batch_size=1000)
+
+        order_ids_by_user = {}
+        for order in orders:
+            order_ids_by_user.setdefault(order.user_id, []).append(order.pk)
+        return Scenario([p.pk for p in products], users, order_ids_by_user)
+
+    def run(self, scenario, weights, options, rng):
+        skipped = sorted(name for name in ORDER_DETAIL_ENDPOINTS if weights[name] and not scenario.buyers)
+        if skipped:
+            self.stdout.write(f"No orders were seeded, skipping {', '.join(skipped)}")
+            weights = {**weights, **dict.fromkeys(skipped, 0)}
+            if not any(weights.values()):
+                raise CommandError("--mix leaves nothing to run")
+        names = [name for name, _, _ in ENDPOINTS]
+        builders = {name: builder for name, _, builder in ENDPOINTS}
+        plan = rng.choices(names, weights=[weights[name] for name in names], k=options['requests'])
+        requests = [(name, builders[name](scenario, rng)) for name in plan]
+        tokens = {user.pk: str(AccessToken.for_user(user)) for user in scenario.users}
+        paying = any(weights[name] for name in PAYMENT_ENDPOINTS)
+
+        if options['asgi']:
+            samples, elapsed = asyncio.run(self.replay_asgi(requests, tokens, options['concurrency']))
+        else:
+            samples, elapsed = self.replay_wsgi(requests, tokens, options['concurrency'])
+
+        by_endpoint = {}
+        for sample in samples:
+            by_endpoint.setdefault(sample['endpoint'], []).append(sample)
+
+        return {
+            'timestamp': timezone.now().isoformat(),
+            'commit': self.git_commit(),
+            'database': {
+                'vendor': connection.vendor,
+                'conn_max_age': connection.settings_dict.get('CONN_MAX_AGE'),
+                'options': {k: str(v) for k, v in connection.settings_dict.get('OPTIONS', {}).items()},
+            },
+            'debug': settings.DEBUG,
+            'scale': {key: options[key] for key in ('products', 'users', 'orders_per_user', 'items_per_order')},
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'handler': 'asgi' if options['asgi'] else 'wsgi',
+            'payment_latency_ms': options['payment_latency'] if paying else None,
+            'elapsed_s': round(elapsed, 3),
+            'overall': summarize(samples, elapsed),
+            'endpoints': {
+                name: summarize(endpoint_samples, elapsed)
+                for name, endpoint_samples in sorted(by_endpoint.items())
+            },
+        }
+
+    def replay_wsgi(self, requests, tokens, concurrency):
+        local = threading.local()
+
+        def send(item):
+            name, (method, path, body, user) = item
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client(raise_request_exception=False)
+            headers = {'HTTP_AUTHORIZATION': f"Bearer {tokens[user.pk]}"} if user else {}
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = getattr(client, method)(path, body, content_type='application/json', **headers)
+                ms = (time.perf_counter() - started) * 1000
+            return {'endpoint': name, 'status': response.status_code, 'ms': round(ms, 3), 'queries': len(queries)}
+
+        def close_connection(_):
+            connection.close()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            started = time.perf_counter()
+            samples = list(pool.map(send, requests))
+            elapsed = time.perf_counter() - started
+            # Each worker thread opened its own connection
+            list(pool.map(close_connection, range(concurrency)))
+        return samples, elapsed
+
+    async def replay_asgi(self, requests, tokens, concurrency):
+        client = AsyncClient(raise_request_exception=False)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def send(item):
+            name, (method, path, body, user) = item
+            headers = {'Authorization': f"Bearer {tokens[user.pk]}"} if user else {}
+            async with slots:
+                started = time.perf_counter()
+                response = await getattr(client, method)(path, body, content_type='application/json', headers=headers)
+                ms = (time.perf_counter() - started) * 1000
+            return {'endpoint': name, 'status': response.status_code, 'ms': round(ms, 3), 'queries': None}
+
+        started = time.perf_counter()
+        samples = await asyncio.gather(*(send(item) for item in requests))
+        elapsed = time.perf_counter() - started
+        # Sync views and the async ORM share asgiref's one sync thread
+        await sync_to_async(connections.close_all)()
+        return samples, elapsed
+
+    def start_payment_stub(self, latency_ms):
+        server = make_server(latency_ms=latency_ms)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stub_settings = override_settings(
+            PAYMENT_GATEWAY='shop.payments.StripeGateway',
+            STRIPE_API_BASE=f"http://127.0.0.1:{server.server_address[1]}",
+            STRIPE_SECRET_KEY='sk_test_stub',
+        )
+        stub_settings.enable()
+        return server, stub_settings
+
+    def stop_payment_stub(self, stub):
+        server, stub_settings = stub
+        stub_settings.disable()
+        server.shutdown()
+        server.server_close()
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, results):
+        header = f"{'endpoint':<22}{'reqs':>7}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+        self.stdout.write(header)
+        rows = list(results['endpoints'].items()) + [('overall', results['overall'])]
+        for name, row in rows:
+            queries = row['queries_per_request']
+            self.stdout.write(
+                f"{name:<22}{row['requests']:>7}{row['errors']:>8}"
+                f"{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+                f"{'-' if queries is None else format(queries, '.2f'):>9}"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"{results['overall']['rps']} req/s over {results['elapsed_s']}s "
+            f"with concurrency {results['concurrency']} ({results['handler'].upper()})"
+        ))
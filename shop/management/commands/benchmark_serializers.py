@@ -0,0 +1,108 @@
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+from django.test import RequestFactory
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+from shop.management.testdb import throwaway_test_database
+from shop.models import Order, OrderItem, Product
+from shop.serializers import OrderItemSerializer, OrderSerializer, ProductSerializer
+
+User = get_user_model()
+
+
+# The same serializers on DRF's stock list path, for comparison
+class DRFProductSerializer(ProductSerializer):
+    class Meta(ProductSerializer.Meta):
+        list_serializer_class = serializers.ListSerializer
+
+
+class DRFOrderItemSerializer(OrderItemSerializer):
+    product = DRFProductSerializer(read_only=True)
+
+    class Meta(OrderItemSerializer.Meta):
+        list_serializer_class = serializers.ListSerializer
+
+
+class DRFOrderSerializer(OrderSerializer):
+    items = DRFOrderItemSerializer(source='orderitem_set', many=True, read_only=True)
+
+    class Meta(OrderSerializer.Meta):
+        list_serializer_class = serializers.ListSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Time list serialization of products and orders on DRF's stock path and on the "
+        "compiled path, and check both render the same bytes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="Products, and order lines, to serialize.")
+        parser.add_argument('--items-per-order', type=int, default=4)
+        parser.add_argument('--repeat', type=int, default=3, help="Best of this many runs is reported.")
+
+    def handle(self, *args, **options):
+        with throwaway_test_database('benchmark_serializers'):
+            products, orders = self.seed(options['rows'], options['items_per_order'])
+            request = RequestFactory().get('/api/products/')
+            cases = [
+                ('products', products, DRFProductSerializer, ProductSerializer),
+                ('orders', orders, DRFOrderSerializer, OrderSerializer),
+            ]
+            self.stdout.write(f"{'serializer':<12}{'rows':>8}{'drf ms':>10}{'compiled ms':>13}{'speedup':>9}")
+            for name, rows, stock, compiled in cases:
+                baseline, stock_ms = self.time(stock, rows, request, options['repeat'])
+                output, compiled_ms = self.time(compiled, rows, request, options['repeat'])
+                if output != baseline:
+                    raise CommandError(f"{name}: compiled output differs from DRF's")
+                self.stdout.write(
+                    f"{name:<12}{len(rows):>8}{stock_ms:>10.1f}{compiled_ms:>13.1f}{stock_ms / compiled_ms:>8.1f}x"
+                )
+
+    def seed(self, rows, items_per_order):
+        Product.objects.bulk_create([
+            Product(
+                name=f"Product {i}", description="Benchmark product", price=Decimal(i % 500) + Decimal('0.99'),
+                stock=100, category=f"category-{i % 20}", image=f"products/{i}.png",
+                image_derivatives={'thumb': {'webp': f"derivatives/{i}-thumb.webp"}},
+            )
+            for i in range(rows)
+        ], batch_size=1000)
+        product_ids = list(Product.objects.values_list('pk', flat=True))
+
+        order_count = max(rows // items_per_order, 1)
+        users = User.objects.bulk_create([User(username=f"bench{i}") for i in range(order_count)])
+        Order.objects.bulk_create(
+            [Order(user=user, status='Successful', total_amount=Decimal('9.99')) for user in users], batch_size=1000
+        )
+        order_ids = list(Order.objects.values_list('pk', flat=True))
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order_id=order_id, product_id=product_ids[(n * items_per_order + i) % len(product_ids)],
+                quantity=i + 1, price=Decimal('2.50') * (i + 1),
+            )
+            for n, order_id in enumerate(order_ids)
+            for i in range(items_per_order)
+        ], batch_size=1000)
+
+        # Loaded once: only serialization is timed
+        products = list(Product.objects.order_by('pk'))
+        orders = list(
+            Order.objects.order_by('pk')
+            .prefetch_related(Prefetch('orderitem_set', queryset=OrderItem.objects.select_related('product')))
+        )
+        return products, orders
+
+    def time(self, serializer_class, rows, request, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            data = serializer_class(rows, many=True, context={'request': request}).data
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        return JSONRenderer().render(data), best
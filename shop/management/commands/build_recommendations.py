@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = "Fold successful orders placed since the last run into the related-products lists."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, help="Related products kept per product (default: RECOMMENDATIONS_PER_PRODUCT).")
+        parser.add_argument('--full', action='store_true', help="Drop everything and recount the whole order history.")
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        run = build_recommendations(k=options['top_k'], full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Counted {run.orders} orders, updated {run.products} products in {time.monotonic() - start:.2f}s"
+        ))
@@ -0,0 +1,70 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from shop.models import Order, OrderItem
+
+
+def items_total():
+    """Subquery summing the line prices of the outer order."""
+    totals = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .order_by()
+        .values('order')
+        .annotate(total=Sum('price'))
+        .values('total')
+    )
+    return Coalesce(
+        Subquery(totals, output_field=DecimalField(max_digits=10, decimal_places=2)),
+        Value(Decimal('0.00')),
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+
+
+class Command(BaseCommand):
+    help = "Verify Order.total_amount against the sum of its OrderItem prices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Rewrite mismatched totals.")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = mismatched = 0
+        last_id = 0
+
+        while True:
+            # Walk the table in primary key ranges so each pass is one
+            # aggregate query no matter how many orders there are.
+            batch = list(
+                Order.objects.filter(pk__gt=last_id)
+                .order_by('pk')
+                .annotate(expected=items_total())
+                .values_list('pk', 'total_amount', 'expected')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            checked += len(batch)
+
+            wrong = []
+            for pk, total, expected in batch:
+                if total != expected:
+                    wrong.append(pk)
+                    self.stdout.write(f"Order {pk}: total_amount={total} items={expected}")
+            mismatched += len(wrong)
+
+            if wrong and options['fix']:
+                with transaction.atomic():
+                    Order.objects.filter(pk__in=wrong).update(total_amount=items_total(), updated_at=timezone.now())
+
+        summary = f"Checked {checked} orders, {mismatched} mismatched"
+        if mismatched and not options['fix']:
+            raise CommandError(summary)
+        if mismatched:
+            summary += " (fixed)"
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,52 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from shop.inventory import available_stock
+from shop.models import Product
+
+FIELDS = ['id', 'name', 'description', 'price', 'stock', 'category', 'image']
+
+
+class Command(BaseCommand):
+    help = "Stream every product to CSV or JSONL in constant memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help="File to write, or - for stdout.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension.")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+
+        # iterator() streams from a server-side cursor where the database
+        # has one, instead of materialising the whole table.
+        # Stock is exported as the total, shards included, which is what
+        # import_products sets it back to.
+        columns = [available_stock() if name == 'stock' else name for name in FIELDS]
+        rows = Product.objects.order_by('pk').values_list(*columns).iterator(chunk_size=options['chunk_size'])
+
+        stream = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        count = 0
+        try:
+            if fmt == 'csv':
+                writer = csv.writer(stream)
+                writer.writerow(FIELDS)
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    record = dict(zip(FIELDS, row))
+                    record['price'] = str(record['price'])
+                    stream.write(json.dumps(record) + '\n')
+                    count += 1
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        if stream is not sys.stdout:
+            self.stdout.write(self.style.SUCCESS(f"Exported {count} products to {path}"))
@@ -0,0 +1,67 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand
+
+from shop.images import needs_derivatives, read_source, render_derivatives, store_derivatives
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnail and WebP derivatives for existing product images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Render processes; 0 renders inline.")
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--force', action='store_true', help="Regenerate up-to-date derivatives too.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        done = skipped = failed = 0
+        pool = None
+        if options['workers']:
+            pool = ProcessPoolExecutor(max_workers=options['workers'], mp_context=get_context('spawn'))
+
+        try:
+            last_id = 0
+            while True:
+                batch = list(
+                    Product.objects.filter(pk__gt=last_id).exclude(image='')
+                    .order_by('pk').only('pk', 'image', 'image_derivatives')[:options['batch_size']]
+                )
+                if not batch:
+                    break
+                last_id = batch[-1].pk
+
+                # Rendering fans out across the pool, one future per product;
+                # files and rows are written from here as results come back.
+                # A product that fails is reported and the backfill goes on.
+                jobs = []
+                for product in batch:
+                    data = None
+                    if options['force'] or needs_derivatives(product):
+                        data = read_source(product.image.name)
+                    if data is None:
+                        skipped += 1
+                    else:
+                        jobs.append((product, pool.submit(render_derivatives, data) if pool else data))
+
+                for product, job in jobs:
+                    try:
+                        rendered = job.result() if pool else render_derivatives(job)
+                        store_derivatives(product.pk, product.image.name, rendered)
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"Product {product.pk} ({product.image.name}): {e}")
+                    else:
+                        done += 1
+                self.stdout.write(f"... {done} generated, {skipped} skipped, {failed} failed")
+        finally:
+            if pool:
+                pool.shutdown()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated derivatives for {done} products ({skipped} skipped, {failed} failed) in {elapsed:.1f}s"
+        ))
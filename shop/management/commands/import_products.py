@@ -0,0 +1,167 @@
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from shop.cache import bump_catalog_version
+from shop.cart import refresh_cart_summaries
+from shop.inventory import set_stock
+from shop.models import Cart, Product
+
+REQUIRED_FIELDS = ['name', 'description', 'price', 'category']
+OPTIONAL_FIELDS = ['stock', 'image']
+FIELDS = REQUIRED_FIELDS + OPTIONAL_FIELDS
+
+
+def read_rows(stream, fmt):
+    """Yield ``(line number, dict)`` one row at a time."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_num, e
+                continue
+            yield line_num, row if isinstance(row, dict) else ValueError("expected a JSON object")
+
+
+def clean_row(row):
+    """Validate one raw row against the Product fields; returns a dict of values."""
+    if isinstance(row, Exception):
+        raise ValidationError(str(row))
+    cleaned = {}
+    errors = {}
+    for name in FIELDS:
+        value = row.get(name)
+        if value in (None, ''):
+            if name in REQUIRED_FIELDS:
+                errors[name] = "This field is required."
+            continue
+        try:
+            cleaned[name] = Product._meta.get_field(name).clean(value, None)
+        except ValidationError as e:
+            errors[name] = '; '.join(e.messages)
+    if row.get('id') not in (None, ''):
+        try:
+            cleaned['id'] = int(row['id'])
+        except (TypeError, ValueError):
+            errors['id'] = "Must be an integer."
+    if errors:
+        raise ValidationError(', '.join(f"{k}: {v}" for k, v in errors.items()))
+    return cleaned
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream products from a CSV or JSONL file (or stdin) and upsert them by id "
+        "in batched transactions. Rows without an id are created."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or - for stdin.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help="Validate only, write nothing.")
+        parser.add_argument('--max-errors', type=int, default=100, help="Abort after this many invalid rows.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.created = self.updated = self.invalid = 0
+        started = time.perf_counter()
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            rows = read_rows(stream, fmt)
+            while True:
+                chunk = list(islice(rows, options['batch_size']))
+                if not chunk:
+                    break
+                valid = []
+                for line_num, row in chunk:
+                    try:
+                        valid.append(clean_row(row))
+                    except ValidationError as e:
+                        self.invalid += 1
+                        self.stderr.write(f"line {line_num}: {'; '.join(e.messages)}")
+                        if self.invalid >= options['max_errors']:
+                            raise CommandError(f"Aborting after {self.invalid} invalid rows")
+                if valid and not options['dry_run']:
+                    self.write_batch(valid)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if self.created:
+                # Rows created with explicit ids don't advance the id sequence
+                with connection.cursor() as cursor:
+                    for sql in connection.ops.sequence_reset_sql(no_style(), [Product]):
+                        cursor.execute(sql)
+            if self.created or self.updated:
+                # Bulk writes skip model signals
+                bump_catalog_version()
+
+        elapsed = time.perf_counter() - started
+        total = self.created + self.updated
+        self.stdout.write(self.style.SUCCESS(
+            f"{self.created} created, {self.updated} updated, {self.invalid} invalid "
+            f"in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s)"
+            + (" [dry run]" if options['dry_run'] else "")
+        ))
+
+    def write_batch(self, rows):
+        # The last row for an id wins; ON CONFLICT DO UPDATE can't touch a
+        # row twice in one statement.
+        last = {row['id']: i for i, row in enumerate(rows) if 'id' in row}
+        rows = [row for i, row in enumerate(rows) if 'id' not in row or last[row['id']] == i]
+
+        now = timezone.now()
+        ids = [row['id'] for row in rows if 'id' in row]
+        existing = set(Product.objects.filter(pk__in=ids).values_list('pk', flat=True)) if ids else set()
+
+        # Rows are grouped by which columns they carry so an update never
+        # blanks out a column the file didn't mention.
+        groups = {}
+        for row in rows:
+            key = tuple(sorted(name for name in row if name != 'id'))
+            groups.setdefault(key, []).append(row)
+
+        with transaction.atomic():
+            for fields, group in groups.items():
+                objs = [Product(**row, updated_at=now) for row in group]
+                creates = [obj for obj in objs if obj.pk is None or obj.pk not in existing]
+                updates = [obj for obj in objs if obj.pk is not None and obj.pk in existing]
+                update_fields = [*fields, 'updated_at']
+
+                if updates and connection.features.supports_update_conflicts_with_target:
+                    # One INSERT ... ON CONFLICT (id) DO UPDATE for the lot
+                    Product.objects.bulk_create(
+                        objs, update_conflicts=True, unique_fields=['id'], update_fields=update_fields
+                    )
+                else:
+                    if creates:
+                        Product.objects.bulk_create(creates)
+                    if updates:
+                        Product.objects.bulk_update(updates, update_fields)
+                self.created += len(creates)
+                self.updated += len(updates)
+                if updates and 'price' in fields:
+                    # Bulk writes skip the signal that reprices carts
+                    refresh_cart_summaries(Cart.objects.filter(cartitem__product__in=[obj.pk for obj in updates]))
+                if updates and 'stock' in fields:
+                    # A sharded product's stock is the total over its shards
+                    stock = {obj.pk: obj.stock for obj in updates}
+                    for pk in Product.objects.filter(pk__in=stock, stock_shard_count__gt=0).values_list('pk', flat=True):
+                        set_stock(pk, stock[pk])
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.webhooks import process_webhook_events
+
+
+class Command(BaseCommand):
+    help = "Apply queued Stripe webhook events to orders in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help="Keep polling for new events.")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to sleep when the inbox is empty.")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            processed = process_webhook_events(options['batch_size'])
+            total += processed
+            if processed:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f"Processed {total} webhook events"))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from shop.cart import refresh_cart_summaries, summary_expressions
+from shop.models import Cart
+
+
+class Command(BaseCommand):
+    help = "Recompute Cart.item_count and Cart.subtotal from the cart lines where they drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report drifted carts.")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        expected = {f'expected_{name}': expression for name, expression in summary_expressions().items()}
+        checked = drifted = 0
+        last_id = 0
+
+        while True:
+            # Primary key ranges keep every pass a single aggregate query
+            batch = list(
+                Cart.objects.filter(pk__gt=last_id)
+                .order_by('pk')
+                .annotate(**expected)
+                .values_list('pk', 'item_count', 'subtotal', 'expected_item_count', 'expected_subtotal')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            checked += len(batch)
+
+            wrong = []
+            for pk, item_count, subtotal, expected_item_count, expected_subtotal in batch:
+                if (item_count, subtotal) != (expected_item_count, expected_subtotal):
+                    wrong.append(pk)
+                    self.stdout.write(
+                        f"Cart {pk}: item_count={item_count} subtotal={subtotal} "
+                        f"lines={expected_item_count} items totalling {expected_subtotal}"
+                    )
+            drifted += len(wrong)
+
+            if wrong and not options['dry_run']:
+                with transaction.atomic():
+                    refresh_cart_summaries(Cart.objects.filter(pk__in=wrong))
+
+        summary = f"Checked {checked} carts, {drifted} drifted"
+        if drifted and options['dry_run']:
+            raise CommandError(summary)
+        if drifted:
+            summary += " (rebuilt)"
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from shop.payment_stub import make_server
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the Stripe PaymentIntent API (set STRIPE_API_BASE to its URL)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=200, help="Milliseconds to wait before answering.")
+
+    def handle(self, *args, **options):
+        server = make_server(options['host'], options['port'], options['latency'])
+        host, port = server.server_address[:2]
+        self.stdout.write(f"Stub payment API on http://{host}:{port} ({options['latency']:g} ms latency)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.inventory import shard_stock
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = "Spread a hot product's stock over N counter rows for a flash sale (--shards 0 folds it back)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_id', type=int)
+        parser.add_argument('--shards', type=int, default=8)
+
+    def handle(self, *args, **options):
+        if options['shards'] < 0:
+            raise CommandError("--shards must be 0 or more")
+        try:
+            total = shard_stock(options['product_id'], options['shards'])
+        except Product.DoesNotExist:
+            raise CommandError(f"No product with id {options['product_id']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Product {options['product_id']}: {total} units over {options['shards'] or 'no'} shards"
+        ))
@@ -0,0 +1,71 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+
+from shop import inventory
+from shop.management.testdb import throwaway_test_database
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        "Sell out one product to many concurrent buyers, with the stock in the product row and "
+        "then spread over shards, and check nothing was oversold."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stock', type=int, default=2000)
+        parser.add_argument('--buyers', type=int, default=32, help="Concurrent buyer threads.")
+        parser.add_argument('--quantity', type=int, default=1, help="Units per purchase.")
+        parser.add_argument('--shards', type=int, default=8)
+
+    def handle(self, *args, **options):
+        with throwaway_test_database('stress'):
+            self.stdout.write(f"{'shards':>6}{'sold':>8}{'left':>6}{'seconds':>9}{'purchases/s':>13}")
+            for shards in sorted({0, options['shards']}):
+                self.sell_out(shards, options)
+
+    def sell_out(self, shards, options):
+        product = Product.objects.create(
+            name="Flash sale", description="Stress test", price=Decimal('1.00'),
+            stock=options['stock'], category='stress', image='',
+        )
+        if shards:
+            inventory.shard_stock(product.pk, shards)
+
+        quantity = options['quantity']
+        sold = []
+        lock = threading.Lock()
+
+        def buyer(_):
+            purchases = 0
+            try:
+                while True:
+                    try:
+                        with transaction.atomic():
+                            short = inventory.take({product.pk: quantity})
+                    except OperationalError:
+                        # SQLite gave up waiting for the write lock; try again
+                        continue
+                    if short:
+                        break
+                    purchases += 1
+            finally:
+                connection.close()
+            with lock:
+                sold.append(purchases)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['buyers']) as executor:
+            list(executor.map(buyer, range(options['buyers'])))
+        elapsed = time.perf_counter() - started
+
+        units = sum(sold) * quantity
+        left = inventory.available([product.pk])[product.pk]
+        self.stdout.write(f"{shards:>6}{units:>8}{left:>6}{elapsed:>9.2f}{sum(sold) / elapsed:>13.0f}")
+        if units + left != options['stock'] or left >= quantity:
+            raise CommandError(f"Stock mismatch: {options['stock']} units, {units} sold, {left} left")
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.maintenance import run_maintenance
+
+
+class Command(BaseCommand):
+    help = "Expire abandoned carts and stale pending orders in rate-limited batches, releasing reserved stock."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help="Rows per transaction (default: MAINTENANCE_BATCH_SIZE).")
+        parser.add_argument('--max-rate', type=float, help="Rows removed per second at most, 0 for no limit (default: MAINTENANCE_MAX_RATE).")
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping on a schedule.")
+        parser.add_argument('--interval', type=float, default=3600, help="Seconds between sweeps with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            for result in run_maintenance(options['batch_size'], options['max_rate']):
+                self.stdout.write(self.style.SUCCESS(f"Expired {result}"))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,35 @@
+"""The throwaway database the benchmark and stress commands run against."""
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+@contextmanager
+def throwaway_test_database(name):
+    """
+    Run the block against a fresh test database, never the real one.
+
+    For SQLite the database goes in a file ``<name>.sqlite3`` in a temporary
+    directory rather than memory, so concurrent connections behave like
+    production. Every connection is closed before it's destroyed.
+    """
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    tmpdir = None
+    if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+        tmpdir = tempfile.mkdtemp()
+        test_settings['NAME'] = os.path.join(tmpdir, f'{name}.sqlite3')
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        if tmpdir:
+            test_settings.pop('NAME', None)
+            shutil.rmtree(tmpdir, ignore_errors=True)
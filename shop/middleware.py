@@ -0,0 +1,99 @@
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .instrumentation import registry
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder:
+    """execute_wrapper that times every query run during one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.statements[(sql, repr(params))] += 1
+
+    @property
+    def duplicates(self):
+        return sum(n - 1 for n in self.statements.values() if n > 1)
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Record query count, SQL time, view time and render time per request.
+
+    Enabled with the SHOP_INSTRUMENTATION setting. When it is off the
+    middleware removes itself from the stack at startup, so it costs
+    nothing. Results are added to a Server-Timing header and aggregated per
+    route for the admin metrics endpoint.
+    """
+
+    def __init__(self, get_response):
+        if not settings.SHOP_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        request._instrumentation = {'view_started': None, 'view_finished': None}
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        finished = time.perf_counter()
+
+        marks = request._instrumentation
+        view_started = marks['view_started'] or started
+        view_finished = marks['view_finished'] or finished
+        sample = {
+            'queries': recorder.count,
+            'duplicate_queries': recorder.duplicates,
+            'sql_ms': recorder.duration * 1000,
+            'view_ms': (view_finished - view_started) * 1000,
+            'render_ms': (finished - view_finished) * 1000,
+            'total_ms': (finished - started) * 1000,
+        }
+
+        match = request.resolver_match
+        route = f"{request.method} /{match.route}" if match else f"{request.method} <unmatched>"
+        registry.record(route, sample)
+
+        if recorder.duplicates:
+            (sql, _), times = recorder.statements.most_common(1)[0]
+            logger.warning("%s ran %d duplicate queries, e.g. %dx: %s", route, recorder.duplicates, times, sql)
+
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={sample["sql_ms"]:.2f};desc="{recorder.count} queries"',
+            f'view;dur={sample["view_ms"]:.2f}',
+            f'render;dur={sample["render_ms"]:.2f}',
+            f'total;dur={sample["total_ms"]:.2f}',
+        ])
+        response['X-Query-Count'] = str(recorder.count)
+        response['X-Duplicate-Queries'] = str(recorder.duplicates)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._instrumentation['view_started'] = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after this hook; everything from here
+        # to the end of the request is serialization.
+        request._instrumentation['view_finished'] = time.perf_counter()
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_cartitem_unique_cart_product'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
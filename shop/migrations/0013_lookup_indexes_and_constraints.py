@@ -0,0 +1,84 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:02
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_carts(apps, schema_editor):
+    Cart = apps.get_model('shop', 'Cart')
+    CartItem = apps.get_model('shop', 'CartItem')
+    duplicates = Cart.objects.values('user_id').annotate(carts=Count('id'), keep=Min('id')).filter(carts__gt=1)
+    for row in duplicates:
+        extra = Cart.objects.filter(user_id=row['user_id']).exclude(id=row['keep'])
+        for item in CartItem.objects.filter(cart__in=extra):
+            kept = CartItem.objects.filter(cart_id=row['keep'], product_id=item.product_id).first()
+            if kept:
+                kept.quantity += item.quantity
+                kept.save(update_fields=['quantity'])
+                item.delete()
+            else:
+                item.cart_id = row['keep']
+                item.save(update_fields=['cart'])
+        extra.delete()
+
+
+def fail_duplicate_pending_orders(apps, schema_editor):
+    # Merging orders would mix up reserved stock and totals, so the oldest
+    # pending order stays pending and the rest are marked Failed; a late
+    # payment for one of them can still move it to Successful.
+    Order = apps.get_model('shop', 'Order')
+    duplicates = (
+        Order.objects.filter(status='Pending')
+        .values('user_id')
+        .annotate(orders=Count('id'), keep=Min('id'))
+        .filter(orders__gt=1)
+    )
+    for row in duplicates:
+        Order.objects.filter(user_id=row['user_id'], status='Pending').exclude(id=row['keep']).update(status='Failed')
+
+
+def merge_duplicate_order_items(apps, schema_editor):
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    duplicates = (
+        OrderItem.objects.values('order_id', 'product_id')
+        .annotate(lines=Count('id'), keep=Min('id'), quantity_total=Sum('quantity'), price_total=Sum('price'))
+        .filter(lines__gt=1)
+    )
+    for row in duplicates:
+        lines = OrderItem.objects.filter(order_id=row['order_id'], product_id=row['product_id'])
+        # Line prices are line totals, so the order total is unchanged
+        lines.filter(id=row['keep']).update(quantity=row['quantity_total'], price=row['price_total'])
+        lines.exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_order_user_created_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_carts, migrations.RunPython.noop),
+        migrations.RunPython(fail_duplicate_pending_orders, migrations.RunPython.noop),
+        migrations.RunPython(merge_duplicate_order_items, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status'], name='order_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category'], name='product_category_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user',), name='unique_user_cart'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'Pending')), fields=('user',), name='unique_pending_order_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'product'), name='unique_order_product'),
+        ),
+    ]
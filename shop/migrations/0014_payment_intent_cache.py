@@ -0,0 +1,27 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_lookup_indexes_and_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='amount',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='client_secret',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('payment_status', 'Pending')), fields=('order', 'method'), name='unique_pending_payment_per_order'),
+        ),
+    ]
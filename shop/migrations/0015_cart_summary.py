@@ -0,0 +1,46 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:18
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_cart_summaries(apps, schema_editor):
+    Cart = apps.get_model('shop', 'Cart')
+    CartItem = apps.get_model('shop', 'CartItem')
+    lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        item_count=Coalesce(
+            Subquery(lines.annotate(total=Sum('quantity')).values('total')),
+            Value(0),
+            output_field=models.PositiveIntegerField(),
+        ),
+        subtotal=Coalesce(
+            Subquery(lines.annotate(total=Sum(F('quantity') * F('product__price'))).values('total')),
+            Value(Decimal('0.00')),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_payment_intent_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.RunPython(fill_cart_summaries, migrations.RunPython.noop),
+    ]
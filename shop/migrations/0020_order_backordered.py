@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0019_stock_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='backordered',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:44
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_stock_shards(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    StockShard = apps.get_model('shop', 'StockShard')
+    shards = StockShard.objects.filter(product=OuterRef('pk')).order_by().values('product')
+    Product.objects.update(
+        stock_shard_count=Coalesce(
+            Subquery(shards.annotate(count=Count('pk')).values('count')),
+            Value(0),
+            output_field=models.PositiveSmallIntegerField(),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0020_order_backordered'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stock_shard_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_stock_shards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0021_product_stock_shard_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='amount_updates',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-18 13:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def record_counted_orders(apps, schema_editor):
+    # Everything up to the last build's watermark has been counted
+    RecommendationRun = apps.get_model('shop', 'RecommendationRun')
+    Order = apps.get_model('shop', 'Order')
+    CoPurchaseOrder = apps.get_model('shop', 'CoPurchaseOrder')
+    last_run = RecommendationRun.objects.order_by('-pk').first()
+    if last_run is None:
+        return
+    order_ids = Order.objects.filter(status='Successful', updated_at__lte=last_run.watermark).values_list('pk', flat=True)
+    CoPurchaseOrder.objects.bulk_create([CoPurchaseOrder(order_id=pk) for pk in order_ids.iterator()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0022_payment_amount_updates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoPurchaseOrder',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='shop.order')),
+            ],
+        ),
+        migrations.RunPython(record_counted_orders, migrations.RunPython.noop),
+    ]
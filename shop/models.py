@@ -8,6 +8,12 @@ class CustomUser(AbstractUser):
     is_admin = models.BooleanField(default=False)
     is_customer = models.BooleanField(default=False)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Email prefix search in the admin user list (username is unique, so already indexed)
+            models.Index(fields=['email'], name='user_email_idx'),
+        ]
+
 class IsAdminUser(BasePermission):
     def has_permission(self, request, view):
         return request.user and request.user.is_authenticated and request.user.is_admin
@@ -17,16 +23,52 @@ class Product(models.Model):
     description = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField(default=0)
+    # StockShard rows the stock is spread over, see shop.inventory
+    stock_shard_count = models.PositiveSmallIntegerField(default=0, editable=False)
     category = models.CharField(max_length=2557)
     image = models.ImageField()
+    # Generated thumbnails/WebP copies of `image`, see shop.images
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['category'], name='product_category_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+class StockShard(models.Model):
+    """Part of a hot product's stock, so concurrent buyers update different rows.
+
+    A product's availability is its ``stock`` plus all of its shards; see
+    shop.inventory.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_shards')
+    shard = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'shard'], name='unique_product_stock_shard'),
+        ]
+
 class Cart(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Also bumped whenever the cart's items change
+    updated_at = models.DateTimeField(auto_now=True)
+    # Maintained by the cart mutation paths (see shop.cart); repaired by
+    # `manage.py rebuild_cart_summaries`
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='unique_user_cart'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s Cart"
@@ -36,14 +78,43 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
     def __str__(self):
         return f"{self.product.name}"
 
+    def line_total(self):
+        return self.quantity * self.product.price
+
 class Order(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=00.00)
     status = models.CharField(default='Pending')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Also bumped whenever the order's items change
+    updated_at = models.DateTimeField(auto_now=True)
+    # Set while the order holds stock taken at checkout
+    reserved_at = models.DateTimeField(null=True, blank=True)
+    # Paid after its stock was given back, with too little left to take
+    # it again: someone has to restock or refund it
+    backordered = models.BooleanField(default=False, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='order_user_created_idx'),
+            models.Index(fields=['user', 'status'], name='order_user_status_idx'),
+        ]
+        constraints = [
+            # Items are always added to "the" pending order, so keep it unique
+            models.UniqueConstraint(
+                fields=['user'],
+                condition=models.Q(status='Pending'),
+                name='unique_pending_order_per_user',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.user.username}'s Order"
@@ -54,8 +125,104 @@ class OrderItem(models.Model):
     quantity = models.PositiveIntegerField(default=0)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=00.00)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'product'], name='unique_order_product'),
+        ]
+
 class Payment(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     transaction_id = models.CharField(max_length=255)
     payment_status = models.CharField(default='Pending')
-    method = models.CharField(max_length=255)
\ No newline at end of file
+    method = models.CharField(max_length=255)
+    # The gateway intent this payment caches, see shop.payments
+    client_secret = models.CharField(max_length=255, blank=True)
+    amount = models.PositiveIntegerField(null=True, blank=True)  # in cents
+    # Bumped by every amount update, so each gets its own idempotency key
+    amount_updates = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['order', 'method'],
+                condition=models.Q(payment_status='Pending'),
+                name='unique_pending_payment_per_order',
+            ),
+        ]
+
+class WebhookEvent(models.Model):
+    """Verified Stripe event waiting for (or done with) processing."""
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.type} {self.event_id}"
+
+class CoPurchase(models.Model):
+    """How many successful orders contained both products (stored both ways round)."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='unique_copurchase_pair'),
+        ]
+
+class CoPurchaseOrder(models.Model):
+    """A successful order whose pairs are in CoPurchase, so it's never counted twice."""
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, primary_key=True, related_name='+')
+
+class ProductRecommendation(models.Model):
+    """A product's top-k co-purchased products, rebuilt by shop.recommendations."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_with')
+    rank = models.PositiveSmallIntegerField()
+    score = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            # Also the index the related-products endpoint reads through
+            models.UniqueConstraint(fields=['product', 'rank'], name='unique_recommendation_rank'),
+        ]
+
+class RecommendationRun(models.Model):
+    """One incremental build; the next one starts after ``watermark``."""
+    watermark = models.DateTimeField()
+    orders = models.PositiveIntegerField(default=0)
+    products = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class DailySales(models.Model):
+    """Successful orders per day, maintained by shop.analytics."""
+    day = models.DateField(unique=True)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+class DailyProductSales(models.Model):
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product'], name='unique_daily_product_sales'),
+        ]
+
+class DailyCategorySales(models.Model):
+    day = models.DateField()
+    category = models.CharField(max_length=2557)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.PositiveIntegerField(default=0)
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category'], name='unique_daily_category_sales'),
+        ]
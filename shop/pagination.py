@@ -0,0 +1,25 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ProductCursorPagination(CursorPagination):
+    # Keyset pagination on the primary key: every page is an indexed range
+    # scan, no matter how deep the client pages into the catalog.
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = '-id'
+
+
+class UserCursorPagination(CursorPagination):
+    # Pages follow the index the filter ranges over, so a prefix search
+    # reads just the matching slice of the username or email index.
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_ordering(self, request, queryset, view):
+        if request.query_params.get('username'):
+            return ('username',)
+        if request.query_params.get('email'):
+            return ('email', 'id')
+        return ('id',)
@@ -0,0 +1,74 @@
+"""A stand-in for the Stripe API, for local runs and benchmarks.
+
+It answers PaymentIntent creates and updates the way Stripe does, after an
+artificial delay, so the payment endpoints can be exercised under load
+without a network or an account. Point ``STRIPE_API_BASE`` at it.
+"""
+import json
+import re
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+INTENT_PATH = re.compile(r"/v1/payment_intents(?:/(?P<id>pi_\w+))?")
+
+
+def payment_intent(params, intent_id=None):
+    intent_id = intent_id or f"pi_stub_{uuid.uuid4().hex[:24]}"
+    return {
+        "id": intent_id,
+        "object": "payment_intent",
+        "amount": int(params.get("amount", 0)),
+        "currency": params.get("currency", "usd"),
+        "status": "requires_payment_method",
+        "client_secret": f"{intent_id}_secret_stub",
+        "livemode": False,
+        # Stripe's form encoding sends metadata as metadata[key]=value
+        "metadata": {
+            key[len("metadata["):-1]: value
+            for key, value in params.items()
+            if key.startswith("metadata[")
+        },
+    }
+
+
+class StubStripeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so clients can reuse pooled connections as with Stripe
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        params = dict(parse_qsl(self.rfile.read(length).decode()))
+        # Create (/v1/payment_intents) or update (/v1/payment_intents/<id>)
+        match = INTENT_PATH.fullmatch(self.path.rstrip("/"))
+        if match is None:
+            return self.send_json(404, {"error": {"type": "invalid_request_error", "message": "Unrecognized request URL"}})
+
+        time.sleep(self.server.latency)
+        self.send_json(200, payment_intent(params, match["id"]))
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Request-Id", f"req_stub_{uuid.uuid4().hex[:14]}")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bursts of concurrent clients would otherwise be refused at the default 5
+    request_queue_size = 128
+
+
+def make_server(host="127.0.0.1", port=0, latency_ms=0):
+    """A threaded stub server; port 0 picks a free port (see server_address)."""
+    server = StubStripeServer((host, port), StubStripeHandler)
+    server.latency = latency_ms / 1000
+    return server
@@ -0,0 +1,265 @@
+"""Payment gateway used to create and reuse PaymentIntents.
+
+``settings.PAYMENT_GATEWAY`` names the gateway class; ``get_gateway()``
+returns one shared instance so its HTTP connections stay pooled across
+requests. StripeGateway talks to Stripe (or the local stub, see
+shop.payment_stub); FakeGateway keeps intents in memory for tests and
+offline runs.
+
+An order's intent is cached on a pending Payment row, so paying again for
+an unchanged order needs no network round trip at all.
+"""
+import functools
+import itertools
+import threading
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from .models import Payment
+
+GATEWAY_SETTINGS = {
+    'PAYMENT_GATEWAY', 'PAYMENT_TIMEOUT', 'PAYMENT_MAX_RETRIES', 'PAYMENT_POOL_SIZE',
+    'STRIPE_SECRET_KEY', 'STRIPE_API_BASE',
+}
+
+
+class PaymentGatewayError(Exception):
+    pass
+
+
+class Intent:
+    def __init__(self, id, client_secret, amount, metadata=None):
+        self.id = id
+        self.client_secret = client_secret
+        self.amount = amount
+        self.metadata = metadata or {}
+
+
+class StripeGateway:
+    """PaymentIntents over pooled keep-alive connections with bounded retries.
+
+    Stripe retries connection errors, 409s and 5xx up to ``max_retries``
+    times with backoff; the idempotency key we pass makes those retries
+    (and concurrent double clicks) return the same intent.
+    """
+    method = 'stripe'
+
+    def __init__(self, api_key, api_base, timeout=10, max_retries=2, pool_size=10):
+        session = Session()
+        # Stripe does the retrying; urllib3 only pools the connections
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        http_client = stripe.RequestsClient(
+            timeout=timeout,
+            session=session,
+            async_fallback_client=stripe.HTTPXClient(timeout=timeout),
+        )
+        self.client = stripe.StripeClient(
+            api_key or '',
+            base_addresses={'api': api_base},
+            http_client=http_client,
+            max_network_retries=max_retries,
+        )
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            settings.STRIPE_SECRET_KEY,
+            settings.STRIPE_API_BASE,
+            timeout=settings.PAYMENT_TIMEOUT,
+            max_retries=settings.PAYMENT_MAX_RETRIES,
+            pool_size=settings.PAYMENT_POOL_SIZE,
+        )
+
+    def _intent(self, intent):
+        return Intent(intent.id, intent.client_secret, intent.amount, dict(intent.metadata or {}))
+
+    def create_intent(self, amount, metadata, idempotency_key):
+        try:
+            intent = self.client.payment_intents.create(
+                params=self._create_params(amount, metadata), options={'idempotency_key': idempotency_key}
+            )
+        except stripe.error.StripeError as e:
+            raise PaymentGatewayError(str(e)) from e
+        return self._intent(intent)
+
+    def update_intent(self, intent_id, amount, idempotency_key):
+        try:
+            intent = self.client.payment_intents.update(
+                intent_id, params={'amount': amount}, options={'idempotency_key': idempotency_key}
+            )
+        except stripe.error.StripeError as e:
+            raise PaymentGatewayError(str(e)) from e
+        return self._intent(intent)
+
+    async def acreate_intent(self, amount, metadata, idempotency_key):
+        try:
+            intent = await self.client.payment_intents.create_async(
+                params=self._create_params(amount, metadata), options={'idempotency_key': idempotency_key}
+            )
+        except stripe.error.StripeError as e:
+            raise PaymentGatewayError(str(e)) from e
+        return self._intent(intent)
+
+    async def aupdate_intent(self, intent_id, amount, idempotency_key):
+        try:
+            intent = await self.client.payment_intents.update_async(
+                intent_id, params={'amount': amount}, options={'idempotency_key': idempotency_key}
+            )
+        except stripe.error.StripeError as e:
+            raise PaymentGatewayError(str(e)) from e
+        return self._intent(intent)
+
+    def _create_params(self, amount, metadata):
+        return {
+            'amount': amount,
+            'currency': 'usd',
+            'automatic_payment_methods': {'enabled': True},
+            'metadata': metadata,
+        }
+
+
+class FakeGateway:
+    """In-memory gateway: no network, and it counts the calls it gets."""
+    method = 'fake'
+
+    def __init__(self):
+        self.intents = {}
+        self.calls = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._by_key = {}
+
+    @classmethod
+    def from_settings(cls):
+        return cls()
+
+    def create_intent(self, amount, metadata, idempotency_key):
+        with self._lock:
+            self.calls += 1
+            if idempotency_key in self._by_key:
+                return self._by_key[idempotency_key]
+            intent_id = f"pi_fake_{next(self._ids)}"
+            intent = Intent(intent_id, f"{intent_id}_secret", amount, metadata)
+            self.intents[intent_id] = self._by_key[idempotency_key] = intent
+            return intent
+
+    def update_intent(self, intent_id, amount, idempotency_key):
+        with self._lock:
+            self.calls += 1
+            # Like Stripe, a reused key replays the first response and
+            # changes nothing
+            if idempotency_key in self._by_key:
+                return self._by_key[idempotency_key]
+            if intent_id not in self.intents:
+                raise PaymentGatewayError(f"No such payment_intent: {intent_id}")
+            intent = self.intents[intent_id]
+            intent.amount = amount
+            self._by_key[idempotency_key] = Intent(intent.id, intent.client_secret, amount, intent.metadata)
+            return intent
+
+    async def acreate_intent(self, amount, metadata, idempotency_key):
+        return self.create_intent(amount, metadata, idempotency_key)
+
+    async def aupdate_intent(self, intent_id, amount, idempotency_key):
+        return self.update_intent(intent_id, amount, idempotency_key)
+
+
+@functools.cache
+def get_gateway():
+    return import_string(settings.PAYMENT_GATEWAY).from_settings()
+
+
+def reset_gateway(*, setting, **kwargs):
+    if setting in GATEWAY_SETTINGS:
+        get_gateway.cache_clear()
+
+
+setting_changed.connect(reset_gateway)
+
+
+def amount_in_cents(order):
+    return int(order.total_amount * 100)
+
+
+def idempotency_key(order, amount, action='create'):
+    # A changed total is a different request, so it gets a different key;
+    # created_at keeps keys apart if order ids are ever reused (fresh database)
+    return f"order-{order.pk}-{order.created_at:%Y%m%d%H%M%S%f}-{action}-{amount}"
+
+
+def update_key(order, payment, amount):
+    # Numbered per payment: a total going A -> B -> A -> B must not replay
+    # the first update to B, which Stripe would answer without applying
+    return idempotency_key(order, amount, f'update-{payment.pk}-{payment.amount_updates + 1}')
+
+
+def cached_payment(order, method):
+    return Payment.objects.filter(order=order, method=method, payment_status='Pending').first()
+
+
+def save_payment(order, method, intent, payment=None):
+    """Record the order's intent; a racing request may have saved it first."""
+    if payment is not None:
+        Payment.objects.filter(pk=payment.pk).update(amount=intent.amount, amount_updates=F('amount_updates') + 1)
+        return
+    try:
+        with transaction.atomic():
+            Payment.objects.create(
+                order=order,
+                method=method,
+                transaction_id=intent.id,
+                client_secret=intent.client_secret,
+                amount=intent.amount,
+            )
+    except IntegrityError:
+        # The other request used the same idempotency key, so it's the same intent
+        pass
+
+
+def payment_intent_for(order):
+    """Client secret of the order's PaymentIntent, creating it only once.
+
+    While the total is unchanged the cached intent is returned without
+    calling the gateway; when it changed, the intent's amount is updated
+    in place so the client secret stays valid.
+    """
+    gateway = get_gateway()
+    amount = amount_in_cents(order)
+    payment = cached_payment(order, gateway.method)
+    if payment is not None and payment.amount == amount:
+        return payment.client_secret
+
+    if payment is not None:
+        intent = gateway.update_intent(payment.transaction_id, amount, update_key(order, payment, amount))
+    else:
+        metadata = {'order_id': order.pk, 'user_id': order.user_id}
+        intent = gateway.create_intent(amount, metadata, idempotency_key(order, amount))
+    save_payment(order, gateway.method, intent, payment)
+    return intent.client_secret
+
+
+async def apayment_intent_for(order):
+    """payment_intent_for for async views: the gateway call is awaited."""
+    gateway = get_gateway()
+    amount = amount_in_cents(order)
+    payment = await Payment.objects.filter(order=order, method=gateway.method, payment_status='Pending').afirst()
+    if payment is not None and payment.amount == amount:
+        return payment.client_secret
+
+    if payment is not None:
+        intent = await gateway.aupdate_intent(payment.transaction_id, amount, update_key(order, payment, amount))
+    else:
+        metadata = {'order_id': order.pk, 'user_id': order.user_id}
+        intent = await gateway.acreate_intent(amount, metadata, idempotency_key(order, amount))
+    await sync_to_async(save_payment)(order, gateway.method, intent, payment)
+    return intent.client_secret
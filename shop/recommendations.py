@@ -0,0 +1,119 @@
+"""Precomputed "frequently bought together" products.
+
+Each build folds the successful orders that came in since the previous
+build into running pair counts (CoPurchase), then rewrites the top-k list
+(ProductRecommendation) of every product those orders touched. Requests
+read the top-k list only, so serving costs one indexed lookup no matter
+how much history there is.
+
+Orders are picked up by the time they last changed rather than by when
+they were created, because an order usually becomes Successful well after
+it was placed. ``RECOMMENDATION_LAG`` seconds are left out of each build,
+so writes that commit late aren't skipped past by the watermark. Later
+saves of an order that was already counted (the Django admin, say) bring
+it back above the watermark, so every counted order is recorded in
+CoPurchaseOrder and skipped from then on.
+"""
+from collections import Counter
+from datetime import timedelta
+from itertools import combinations, groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import CoPurchase, CoPurchaseOrder, Order, OrderItem, ProductRecommendation, RecommendationRun
+from .utils import CHUNK_SIZE, chunked
+
+
+def count_pairs(order_items):
+    """Co-occurrence counts from ``(order_id, product_id)`` rows sorted by order.
+
+    Each order counts once per pair however many units it has, and every
+    pair is counted both ways round, so a product's row set is complete.
+    """
+    pairs = Counter()
+    for _, rows in groupby(order_items, key=lambda row: row[0]):
+        products = sorted({product_id for _, product_id in rows})
+        for first, second in combinations(products, 2):
+            pairs[first, second] += 1
+            pairs[second, first] += 1
+    return pairs
+
+
+def add_pair_counts(pairs):
+    """Add ``{(product_id, related_id): count}`` to the stored counts."""
+    by_product = {}
+    for (product_id, related_id), count in pairs.items():
+        by_product.setdefault(product_id, {})[related_id] = count
+
+    rows = []
+    for product_ids in chunked(by_product):
+        existing = CoPurchase.objects.filter(product_id__in=product_ids).values_list('product_id', 'related_id', 'count')
+        totals = {(product_id, related_id): count for product_id, related_id, count in existing}
+        for product_id in product_ids:
+            for related_id, count in by_product[product_id].items():
+                total = totals.get((product_id, related_id), 0) + count
+                rows.append(CoPurchase(product_id=product_id, related_id=related_id, count=total))
+    CoPurchase.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=['product', 'related'],
+        update_fields=['count'],
+        batch_size=CHUNK_SIZE,
+    )
+
+
+def rebuild_top_k(product_ids, k):
+    """Rewrite the top-k recommendations of the given products from their counts."""
+    for chunk in chunked(sorted(product_ids)):
+        counts = (
+            CoPurchase.objects.filter(product_id__in=chunk)
+            .order_by('product_id', '-count', 'related_id')
+            .values_list('product_id', 'related_id', 'count')
+        )
+        recommendations = []
+        for product_id, rows in groupby(counts, key=lambda row: row[0]):
+            for rank, (_, related_id, count) in enumerate(list(rows)[:k], start=1):
+                recommendations.append(
+                    ProductRecommendation(product_id=product_id, related_id=related_id, rank=rank, score=count)
+                )
+        ProductRecommendation.objects.filter(product_id__in=chunk).delete()
+        ProductRecommendation.objects.bulk_create(recommendations, batch_size=CHUNK_SIZE)
+
+
+def build_recommendations(k=None, full=False):
+    """
+    Fold new successful orders into the recommendations; returns the run.
+
+    ``full`` discards everything and recounts the whole history. Counts,
+    counted orders, top-k lists and watermark are saved in one
+    transaction, so a failed build leaves the previous one in place and
+    simply gets redone.
+    """
+    k = k or settings.RECOMMENDATIONS_PER_PRODUCT
+    until = timezone.now() - timedelta(seconds=settings.RECOMMENDATION_LAG)
+    with transaction.atomic():
+        last_run = None if full else RecommendationRun.objects.order_by('-pk').first()
+        if full:
+            CoPurchase.objects.all().delete()
+            CoPurchaseOrder.objects.all().delete()
+            ProductRecommendation.objects.all().delete()
+
+        orders = Order.objects.filter(status='Successful', updated_at__lte=until)
+        if last_run is not None:
+            orders = orders.filter(updated_at__gt=last_run.watermark)
+        order_ids = list(orders.exclude(pk__in=CoPurchaseOrder.objects.values('order')).values_list('pk', flat=True))
+        CoPurchaseOrder.objects.bulk_create(
+            [CoPurchaseOrder(order_id=order_id) for order_id in order_ids], batch_size=CHUNK_SIZE
+        )
+
+        pairs = Counter()
+        for chunk in chunked(order_ids):
+            items = OrderItem.objects.filter(order_id__in=chunk).order_by('order_id').values_list('order_id', 'product_id')
+            pairs.update(count_pairs(items))
+
+        add_pair_counts(pairs)
+        touched = {product_id for product_id, _ in pairs}
+        rebuild_top_k(touched, k)
+        return RecommendationRun.objects.create(watermark=until, orders=len(order_ids), products=len(touched))
@@ -0,0 +1,216 @@
+import re
+from decimal import Decimal
+
+from django.db.models import Count, Q
+
+from .inventory import with_available_stock
+from .models import Product
+
+FTS_TABLE = 'shop_product_fts'
+
+# Column weights for bm25(): a hit in the name counts most.
+RANK_WEIGHTS = (10.0, 2.0, 5.0)
+
+# (min, max) price buckets reported as facets; None means unbounded.
+PRICE_RANGES = [
+    (None, Decimal('10')),
+    (Decimal('10'), Decimal('25')),
+    (Decimal('25'), Decimal('50')),
+    (Decimal('50'), Decimal('100')),
+    (Decimal('100'), Decimal('250')),
+    (Decimal('250'), None),
+]
+
+CATEGORY_FACET_LIMIT = 20
+
+# Most matches facets are counted over; beyond this they are estimates.
+FACET_SAMPLE_SIZE = 10000
+
+_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        name, description, category,
+        content='shop_product', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON shop_product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, description, category)
+        VALUES (new.id, new.name, new.description, new.category);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON shop_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description, category)
+        VALUES ('delete', old.id, old.name, old.description, old.category);
+    END""",
+    # Only the indexed columns, so stock and price updates never touch the index
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF name, description, category ON shop_product BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description, category)
+        VALUES ('delete', old.id, old.name, old.description, old.category);
+        INSERT INTO {FTS_TABLE}(rowid, name, description, category)
+        VALUES (new.id, new.name, new.description, new.category);
+    END""",
+]
+
+
+def ensure_search_index(connection):
+    """
+    Create the FTS5 index over Product and the triggers keeping it in sync.
+
+    Runs after every migrate rather than from a migration: SQLite migrations
+    that rebuild shop_product drop its triggers, and this puts them back
+    (re-indexing everything when it has to). A no-op on other databases.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+            [f"{FTS_TABLE}_%"],
+        )
+        complete = cursor.fetchone()[0] == 3
+        for statement in _SCHEMA:
+            cursor.execute(statement)
+        if not complete:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def match_expression(query):
+    """Turn free text into a safe FTS5 query: all terms, last one as a prefix."""
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _filters(category, min_price, max_price, alias='p'):
+    sql, params = [], []
+    if category is not None:
+        sql.append(f"{alias}.category = %s")
+        params.append(category)
+    if min_price is not None:
+        sql.append(f"{alias}.price >= %s")
+        params.append(str(min_price))
+    if max_price is not None:
+        sql.append(f"{alias}.price <= %s")
+        params.append(str(max_price))
+    return ''.join(f" AND {clause}" for clause in sql), params
+
+
+def _price_bucket_sql(column):
+    cases, params = [], []
+    for low, high in PRICE_RANGES:
+        conditions = []
+        if low is not None:
+            conditions.append(f"{column} >= %s")
+            params.append(str(low))
+        if high is not None:
+            conditions.append(f"{column} < %s")
+            params.append(str(high))
+        cases.append(f"SUM(CASE WHEN {' AND '.join(conditions)} THEN 1 ELSE 0 END)")
+    return ', '.join(cases), params
+
+
+def _price_facets(counts):
+    return [
+        {'min': low, 'max': high, 'count': count or 0}
+        for (low, high), count in zip(PRICE_RANGES, counts)
+    ]
+
+
+def _search_sqlite(connection, match, category, min_price, max_price, limit, offset):
+    matches = f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s"
+    weights = ', '.join(str(w) for w in RANK_WEIGHTS)
+    where, params = _filters(category, min_price, max_price)
+
+    with connection.cursor() as cursor:
+        if where:
+            base = f"FROM {FTS_TABLE} f JOIN shop_product p ON p.id = f.rowid WHERE {FTS_TABLE} MATCH %s"
+            cursor.execute(
+                f"SELECT p.id {base}{where} ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s OFFSET %s",
+                [match, *params, limit, offset],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(f"SELECT count(*) {base}{where}", [match, *params])
+            count = cursor.fetchone()[0]
+        else:
+            # Without filters the index alone answers, no join needed
+            cursor.execute(
+                f"{matches} ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s OFFSET %s",
+                [match, limit, offset],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(f"SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match])
+            count = cursor.fetchone()[0]
+
+        # Facets are counted over at most FACET_SAMPLE_SIZE matches so very
+        # broad queries stay cheap; `sampled` tells the client they are
+        # approximate. Each facet ignores its own filter so clients can
+        # switch between values.
+        cursor.execute(f"SELECT count(*) FROM ({matches} LIMIT %s)", [match, FACET_SAMPLE_SIZE + 1])
+        sampled = cursor.fetchone()[0] > FACET_SAMPLE_SIZE
+        sample = f"FROM ({matches} LIMIT {FACET_SAMPLE_SIZE}) f JOIN shop_product p ON p.id = f.rowid WHERE 1 = 1"
+
+        where, params = _filters(None, min_price, max_price)
+        cursor.execute(
+            f"SELECT p.category, count(*) AS n {sample}{where} GROUP BY p.category ORDER BY n DESC, p.category LIMIT %s",
+            [match, *params, CATEGORY_FACET_LIMIT],
+        )
+        categories = [{'value': value, 'count': n} for value, n in cursor.fetchall()]
+
+        buckets, bucket_params = _price_bucket_sql('p.price')
+        where, params = _filters(category, None, None)
+        cursor.execute(f"SELECT {buckets} {sample}{where}", [*bucket_params, match, *params])
+        prices = _price_facets(cursor.fetchone())
+
+    return ids, count, {'category': categories, 'price': prices, 'sampled': sampled}
+
+
+def _search_fallback(query, category, min_price, max_price, limit, offset):
+    # Unranked substring matching for databases without the FTS5 index
+    matches = Product.objects.all()
+    for term in re.findall(r'\w+', query):
+        matches = matches.filter(
+            Q(name__icontains=term) | Q(description__icontains=term) | Q(category__icontains=term)
+        )
+    price_filter = Q()
+    if min_price is not None:
+        price_filter &= Q(price__gte=min_price)
+    if max_price is not None:
+        price_filter &= Q(price__lte=max_price)
+    category_filter = Q(category=category) if category is not None else Q()
+
+    results = matches.filter(price_filter & category_filter)
+    ids = list(results.order_by('pk').values_list('pk', flat=True)[offset:offset + limit])
+    categories = [
+        {'value': row['category'], 'count': row['n']}
+        for row in matches.filter(price_filter).values('category')
+        .annotate(n=Count('pk')).order_by('-n', 'category')[:CATEGORY_FACET_LIMIT]
+    ]
+    prices = matches.filter(category_filter).aggregate(**{
+        f"bucket{i}": Count('pk', filter=(Q(price__gte=low) if low is not None else Q())
+                            & (Q(price__lt=high) if high is not None else Q()))
+        for i, (low, high) in enumerate(PRICE_RANGES)
+    })
+    facets = {'category': categories, 'price': _price_facets(prices.values()), 'sampled': False}
+    return ids, results.count(), facets
+
+
+def search_products(connection, query, category=None, min_price=None, max_price=None, limit=20, offset=0):
+    """
+    Ranked search over product name, description and category.
+
+    Returns ``(products, count, facets)`` where products is one page of
+    Product instances in rank order.
+    """
+    match = match_expression(query)
+    if match is None:
+        facets = {'category': [], 'price': _price_facets([0] * len(PRICE_RANGES)), 'sampled': False}
+        return [], 0, facets
+
+    if connection.vendor == 'sqlite':
+        ids, count, facets = _search_sqlite(connection, match, category, min_price, max_price, limit, offset)
+    else:
+        ids, count, facets = _search_fallback(query, category, min_price, max_price, limit, offset)
+
+    products = with_available_stock().in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products], count, facets
@@ -1,6 +1,9 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
 from django.contrib.auth.password_validation import validate_password
+from . import inventory
+from .compiled_serializers import CompiledListSerializer
 from .models import Product, Cart, CartItem, Order, OrderItem, Payment
 
 User = get_user_model()
@@ -20,10 +23,68 @@ class RegisterSerializer(serializers.ModelSerializer):
         )
         return user
     
+class UserListSerializer(serializers.ModelSerializer):
+    """Read-only listing of accounts; serializes ``values()`` rows of just these columns."""
+
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'email', 'is_admin', 'is_active', 'date_joined')
+        read_only_fields = fields
+
+class StockField(serializers.IntegerField):
+    """
+    Units available, shards included: the ``available_stock`` annotation
+    (see inventory.with_available_stock). Never queries, so it's safe in
+    lists and async views; unannotated products show the stock column.
+    """
+
+    def get_attribute(self, instance):
+        return getattr(instance, 'available_stock', instance.stock)
+
 class ProductSerializer(serializers.ModelSerializer):
+    image_derivatives = serializers.SerializerMethodField()
+
     class Meta:
         model = Product
         fields = "__all__"
+        list_serializer_class = CompiledListSerializer
+
+    def build_standard_field(self, field_name, model_field):
+        field_class, field_kwargs = super().build_standard_field(field_name, model_field)
+        if field_name == 'stock':
+            field_class = StockField
+        return field_class, field_kwargs
+
+    def update(self, instance, validated_data):
+        # Written as the total, like it's read: spread over the shards
+        stock = validated_data.pop('stock', None) if instance.stock_shard_count else None
+        instance = super().update(instance, validated_data)
+        if stock is not None:
+            inventory.set_stock(instance.pk, stock)
+            instance.refresh_from_db(fields=['stock', 'stock_shard_count'])
+        if hasattr(instance, 'available_stock'):
+            instance.available_stock = inventory.available([instance.pk])[instance.pk]
+        return instance
+
+    def get_image_derivatives(self, obj):
+        request = self.context.get('request')
+        urls = {}
+        for name, files in obj.image_derivatives.items():
+            if name == 'source':
+                continue
+            urls[name] = {}
+            for fmt, path in files.items():
+                url = default_storage.url(path)
+                urls[name][fmt] = request.build_absolute_uri(url) if request else url
+        return urls
+
+class ProductSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(max_length=255)
+    category = serializers.CharField(required=False)
+    min_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, min_value=0)
+    max_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, min_value=0)
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=20)
+    offset = serializers.IntegerField(min_value=0, default=0)
 
 class CartItemSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)   
@@ -34,7 +95,22 @@ class CartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = "__all__"
-        read_only_fields = ['id', 'product']
+        read_only_fields = ['id', 'product', 'cart']
+
+class CartItemUpdateSerializer(CartItemSerializer):
+    """A cart line's quantity; moving a line to another product is an add, not an update."""
+    product_id = None
+
+    class Meta(CartItemSerializer.Meta):
+        fields = ['id', 'cart', 'product', 'quantity']
+        extra_kwargs = {'quantity': {'min_value': 1}}
+
+class CartLineSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+class CartBulkAddSerializer(serializers.Serializer):
+    items = CartLineSerializer(many=True, allow_empty=False)
 
 class CartSerializer(serializers.ModelSerializer):
     items = CartItemSerializer(source='cartitem_set', many=True, read_only=True)
@@ -44,6 +120,11 @@ class CartSerializer(serializers.ModelSerializer):
         fields = "__all__"
         read_only_fields = ['user', 'created_at']
 
+class CartSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Cart
+        fields = ['item_count', 'subtotal', 'updated_at']
+
 class OrderItemSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
     product_id = serializers.PrimaryKeyRelatedField(
@@ -53,6 +134,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
         fields = "__all__"
+        list_serializer_class = CompiledListSerializer
 
 class OrderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(source='orderitem_set', many=True, read_only=True)
@@ -60,6 +142,38 @@ class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = "__all__"
+        list_serializer_class = CompiledListSerializer
+
+class OrderExportSerializer(serializers.Serializer):
+    type = serializers.ChoiceField(choices=['ndjson', 'csv'], default='ndjson')
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+class SalesReportQuerySerializer(serializers.Serializer):
+    start = serializers.DateField()
+    end = serializers.DateField()  # exclusive
+    by = serializers.ChoiceField(choices=['day', 'product', 'category'], default='day')
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+    def validate(self, attrs):
+        if attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError("start must be before end")
+        return attrs
+
+class SalesTotalsSerializer(serializers.Serializer):
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    units = serializers.IntegerField()
+    orders = serializers.IntegerField()
+
+class SalesReportRowSerializer(serializers.Serializer):
+    # Only the keys of the report's grouping are present
+    day = serializers.DateField(required=False)
+    product_id = serializers.IntegerField(required=False)
+    name = serializers.CharField(source='product__name', required=False)
+    category = serializers.CharField(required=False)
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    units = serializers.IntegerField()
+    orders = serializers.IntegerField()
 
 class PaymentSerializer(serializers.ModelSerializer):
     order = OrderSerializer(read_only=True)
@@ -0,0 +1,65 @@
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .authentication import user_cache_key
+from .cache import bump_catalog_version
+from .cart import refresh_cart_summaries
+from .images import needs_derivatives, schedule_derivatives
+from .models import Cart, CartItem, CustomUser, Product
+from .search import ensure_search_index
+
+
+def install_search_index(sender, using, **kwargs):
+    ensure_search_index(connections[using])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog(sender, **kwargs):
+    # Covers the API, the Django admin and scripts alike; bulk stock
+    # updates bump the version themselves.
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(pre_save, sender=Product)
+def note_price_change(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields is not None and 'price' not in update_fields):
+        instance._price_changed = False
+        return
+    old_price = Product.objects.filter(pk=instance.pk).values_list('price', flat=True).first()
+    # The instance may still hold the price as assigned, e.g. a string
+    instance._price_changed = old_price != sender._meta.get_field('price').to_python(instance.price)
+
+
+@receiver(post_save, sender=Product)
+def refresh_carts_with_product(sender, instance, created, **kwargs):
+    # Cart subtotals are priced at the current product price
+    if not created and getattr(instance, '_price_changed', True):
+        refresh_cart_summaries(Cart.objects.filter(cartitem__product=instance))
+
+
+@receiver(pre_delete, sender=Product)
+def note_carts_with_product(sender, instance, **kwargs):
+    # The cascade removes the cart lines before post_delete can see them
+    instance._cart_ids = list(CartItem.objects.filter(product=instance).values_list('cart_id', flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def refresh_carts_without_product(sender, instance, **kwargs):
+    if getattr(instance, '_cart_ids', None):
+        refresh_cart_summaries(Cart.objects.filter(pk__in=instance._cart_ids))
+
+
+@receiver(post_save, sender=Product)
+def generate_image_derivatives(sender, instance, **kwargs):
+    if needs_derivatives(instance):
+        transaction.on_commit(lambda: schedule_derivatives(instance))
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Deactivation and password changes must reach JWT auth right away
+    transaction.on_commit(lambda: cache.delete(user_cache_key(instance.pk)))
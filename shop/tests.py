@@ -1,3 +1,1407 @@
-from django.test import TestCase
+import csv
+import json
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .authentication import token_cache
+from .cart import add_to_cart
+from . import inventory
+from .checkout import InsufficientStock, checkout, release_stock
+from .images import read_source, render_derivatives, store_derivatives
+from .instrumentation import registry
+from .maintenance import run_maintenance
+from .management.commands.benchmark import ENDPOINTS, Scenario
+from .management.commands.benchmark_serializers import DRFOrderSerializer, DRFProductSerializer
+from .middleware import QueryRecorder
+from .payment_stub import make_server
+from .payments import get_gateway
+from .recommendations import build_recommendations
+from .search import _search_fallback
+from .serializers import OrderSerializer, ProductSerializer
+from .views import order_items_prefetch, prefix_range
+from .models import (
+    Cart, CartItem, CoPurchase, CustomUser, DailyCategorySales, DailyProductSales, DailySales, Order, OrderItem,
+    Payment, Product, ProductRecommendation, StockShard, WebhookEvent,
+)
+from .webhooks import fake_event, fake_webhook_request, process_webhook_events, store_event
 
 # Create your tests here.
+
+
+def make_product(**kwargs):
+    fields = {
+        'name': 'Widget',
+        'description': 'A widget',
+        'price': '10.00',
+        'stock': 10,
+        'category': 'tools',
+        'image': 'widget.png',
+    }
+    fields.update(kwargs)
+    return Product.objects.create(**fields)
+
+
+class ShopTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user(username='customer')
+        self.admin = CustomUser.objects.create_user(
+            username='admin', is_admin=True, is_staff=True
+        )
+
+
+class UserListTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.admin)
+        for name in ['alice', 'alan', 'Alfred', 'bob', 'albert']:
+            CustomUser.objects.create_user(username=name, email=f'{name.lower()}@example.com')
+
+    def test_pages_through_users_without_private_columns(self):
+        url, seen = reverse('users') + '?page_size=3', []
+        while url:
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            seen += [user['username'] for user in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(sorted(seen), sorted(CustomUser.objects.values_list('username', flat=True)))
+        self.assertEqual(
+            set(response.data['results'][0]), {'id', 'username', 'email', 'is_admin', 'is_active', 'date_joined'}
+        )
+
+    def test_prefix_filters(self):
+        def usernames(**params):
+            return [user['username'] for user in self.client.get(reverse('users'), params).data['results']]
+
+        self.assertEqual(usernames(username='al'), ['alan', 'albert', 'alice'])
+        self.assertEqual(usernames(email='al'), ['alan', 'albert', 'Alfred', 'alice'])
+        self.assertEqual(usernames(username='al', email='ali'), ['alice'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'checks SQLite query plans')
+    def test_prefix_filters_use_indexes(self):
+        plan = CustomUser.objects.filter(**prefix_range('email', 'al')).order_by('email', 'id').explain()
+        self.assertIn('USING INDEX user_email_idx', plan)
+        plan = CustomUser.objects.filter(**prefix_range('username', 'al')).order_by('username').explain()
+        self.assertIn('USING INDEX sqlite_autoindex_shop_customuser', plan)
+
+    def test_admin_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(reverse('users')).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ProductCatalogTests(ShopTestCase):
+    def test_list_is_cursor_paginated(self):
+        for i in range(5):
+            make_product(name=f'p{i}')
+
+        response = self.client.get(reverse('products'), {'page_size': 2})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([p['name'] for p in response.data['results']], ['p4', 'p3'])
+        self.assertIn('cursor=', response.data['next'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([p['name'] for p in response.data['results']], ['p2', 'p1'])
+
+    def test_list_is_served_from_cache(self):
+        make_product()
+        self.client.get(reverse('products'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('products'))
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_admin_writes_invalidate_cached_pages(self):
+        product = make_product(price='10.00')
+        self.client.get(reverse('products'))
+
+        self.client.force_authenticate(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(reverse('product_detail', args=[product.pk]), {'price': '12.50'})
+        self.client.force_authenticate(None)
+
+        response = self.client.get(reverse('products'))
+        self.assertEqual(response.data['results'][0]['price'], '12.50')
+
+        self.client.force_authenticate(self.admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('product_detail', args=[product.pk]))
+        self.client.force_authenticate(None)
+
+        response = self.client.get(reverse('products'))
+        self.assertEqual(response.data['results'], [])
+
+
+class NestedReadQueryBudgetTests(ShopTestCase):
+    # Queries each endpoint may issue regardless of how many rows it returns
+    # (authentication is forced, so no user lookup is counted).
+    CART_DETAIL_QUERIES = 4
+    ORDER_LIST_QUERIES = 3
+    ORDER_DETAIL_QUERIES = 4
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.products = [make_product(name=f'p{i}') for i in range(6)]
+
+    def make_orders(self, count, items_per_order):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, status='Successful')
+            for product in self.products[:items_per_order]:
+                OrderItem.objects.create(order=order, product=product, quantity=1, price=product.price)
+        return order
+
+    def test_cart_detail(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.products[0], quantity=1)
+        with self.assertNumQueries(self.CART_DETAIL_QUERIES):
+            self.client.get(reverse('cart_detail'))
+
+        for product in self.products[1:]:
+            CartItem.objects.create(cart=cart, product=product, quantity=1)
+        with self.assertNumQueries(self.CART_DETAIL_QUERIES):
+            response = self.client.get(reverse('cart_detail'))
+        self.assertEqual(len(response.data['items']), len(self.products))
+
+    def test_order_list(self):
+        self.make_orders(1, 1)
+        with self.assertNumQueries(self.ORDER_LIST_QUERIES):
+            self.client.get(reverse('orders'))
+
+        self.make_orders(10, len(self.products))
+        with self.assertNumQueries(self.ORDER_LIST_QUERIES):
+            response = self.client.get(reverse('orders'))
+        self.assertEqual(len(response.data), 11)
+
+    def test_order_detail(self):
+        order = self.make_orders(1, len(self.products))
+        with self.assertNumQueries(self.ORDER_DETAIL_QUERIES):
+            response = self.client.get(reverse('order_detail', args=[order.pk]))
+        self.assertEqual(len(response.data['items']), len(self.products))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'asserts on SQLite query plans')
+class LookupIndexTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+        self.cart = Cart.objects.create(user=self.user)
+        self.order = Order.objects.create(user=self.user)
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index}', plan)
+        # any SCAN of a shop table is a full table scan
+        self.assertNotIn('SCAN shop_', plan)
+
+    def test_hot_lookups_use_indexes(self):
+        # The lookups get_or_create issues in the cart, order and checkout paths
+        self.assertUsesIndex(
+            Order.objects.select_for_update().filter(user=self.user, status='Pending'), 'order_user_status_idx'
+        )
+        self.assertUsesIndex(Order.objects.filter(user=self.user).order_by('-created_at'), 'order_user_created_idx')
+        self.assertUsesIndex(Cart.objects.filter(user=self.user), 'sqlite_autoindex_shop_cart')
+        self.assertUsesIndex(
+            CartItem.objects.filter(cart=self.cart, product=self.product), 'sqlite_autoindex_shop_cartitem'
+        )
+        self.assertUsesIndex(
+            OrderItem.objects.filter(order=self.order, product=self.product), 'sqlite_autoindex_shop_orderitem'
+        )
+        self.assertUsesIndex(Product.objects.filter(category='tools'), 'product_category_idx')
+
+    def test_one_pending_order_per_user(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Order.objects.create(user=self.user)
+
+        Order.objects.create(user=self.user, status='Successful')
+        order, created = Order.objects.get_or_create(user=self.user, status='Pending')
+        self.assertEqual((order, created), (self.order, False))
+
+
+@override_settings(RECOMMENDATION_LAG=0)
+class RecommendationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.a, self.b, self.c, self.d = [make_product(name=name) for name in 'abcd']
+
+    def order(self, *products, status='Successful'):
+        order = Order.objects.create(user=self.user, status=status)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=product, quantity=2) for product in products])
+        return order
+
+    def related(self, product):
+        response = self.client.get(reverse('product_related', args=[product.pk]))
+        return [item['id'] for item in response.data]
+
+    def test_builds_top_k_incrementally(self):
+        self.order(self.a, self.b, self.c)
+        self.order(self.a, self.b)
+        self.order(self.a, self.c)
+        self.order(self.c, self.d, status='Pending')
+
+        run = build_recommendations(k=3)
+        self.assertEqual((run.orders, run.products), (3, 3))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.related(self.a), [self.b.pk, self.c.pk])
+        self.assertEqual(self.related(self.d), [])
+        self.assertEqual(self.client.get('/api/products/abc/related/').status_code, status.HTTP_404_NOT_FOUND)
+
+        # Only the new order is counted, and only its products are redone
+        self.order(self.c, self.d)
+        run = build_recommendations(k=3)
+        self.assertEqual((run.orders, run.products), (1, 2))
+        self.assertEqual(self.related(self.c), [self.a.pk, self.b.pk, self.d.pk])
+        self.assertEqual(
+            list(ProductRecommendation.objects.filter(product=self.c).values_list('score', flat=True)), [2, 1, 1]
+        )
+        self.assertEqual(build_recommendations().orders, 0)
+
+        # Saving a counted order again (e.g. in the Django admin) doesn't recount it
+        self.order(self.a, self.d)
+        self.assertEqual(build_recommendations().orders, 1)
+        for order in Order.objects.filter(status='Successful'):
+            order.save()
+        self.assertEqual(build_recommendations().orders, 0)
+        self.assertEqual(CoPurchase.objects.get(product=self.a, related=self.b).count, 2)
+
+    def test_full_rebuild(self):
+        self.order(self.a, self.b)
+        self.order(self.a, self.c)
+        self.order(self.a, self.c)
+        build_recommendations()
+        build_recommendations()
+
+        call_command('build_recommendations', '--full', '--top-k', '1', stdout=StringIO())
+        self.assertEqual(self.related(self.a), [self.c.pk])
+        self.assertEqual(CoPurchase.objects.get(product=self.a, related=self.c).count, 2)
+
+
+class CompiledSerializerTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.request = APIRequestFactory().get('/api/products/')
+        self.products = [
+            make_product(name='plain', price='0.10', image=''),
+            make_product(name='thumbs', price='1234.50', image_derivatives={
+                'source': 'widget.png', 'thumb': {'webp': 'derivatives/thumb.webp', 'jpeg': 'derivatives/thumb.jpg'},
+            }),
+        ]
+        for i, buyer in enumerate([self.user, self.admin]):
+            order = Order.objects.create(user=buyer, total_amount='7.25', reserved_at=timezone.now() if i else None)
+            OrderItem.objects.create(order=order, product=self.products[i], quantity=3, price='7.25')
+        Order.objects.create(user=self.user, status='Successful')
+
+    def render(self, serializer_class, rows):
+        return JSONRenderer().render(serializer_class(rows, many=True, context={'request': self.request}).data)
+
+    def test_output_is_byte_identical_to_drf(self):
+        products = Product.objects.order_by('pk')
+        self.assertEqual(self.render(ProductSerializer, products), self.render(DRFProductSerializer, products))
+
+        orders = Order.objects.order_by('pk').prefetch_related(order_items_prefetch())
+        self.assertEqual(self.render(OrderSerializer, orders), self.render(DRFOrderSerializer, orders))
+
+
+class CartMutationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.products = [make_product(name=f'p{i}') for i in range(5)]
+
+    def test_add_increments_existing_line(self):
+        product = self.products[0]
+        self.client.post(reverse('add_item'), {'product_id': product.pk, 'quantity': 2})
+        response = self.client.post(reverse('add_item'), {'product_id': product.pk, 'quantity': 3})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['quantity'], 5)
+        self.assertEqual(response.data['product']['id'], product.pk)
+        self.assertEqual(CartItem.objects.filter(cart__user=self.user).count(), 1)
+
+    def test_add_unknown_product(self):
+        response = self.client.post(reverse('add_item'), {'product_id': 999})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_many_merges_lines(self):
+        first, second = self.products[:2]
+        self.client.post(reverse('add_item'), {'product_id': first.pk, 'quantity': 1})
+        response = self.client.post(reverse('add_items'), {'items': [
+            {'product_id': first.pk, 'quantity': 2},
+            {'product_id': second.pk},
+            {'product_id': second.pk, 'quantity': 4},
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        quantities = dict(CartItem.objects.values_list('product_id', 'quantity'))
+        self.assertEqual(quantities, {first.pk: 3, second.pk: 5})
+
+    def test_add_many_rejects_unknown_products_atomically(self):
+        response = self.client.post(reverse('add_items'), {'items': [
+            {'product_id': self.products[0].pk},
+            {'product_id': 999},
+        ]}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['product_ids'], [999])
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_add_many_query_count_is_constant(self):
+        def add(products):
+            items = [{'product_id': p.pk, 'quantity': 1} for p in products]
+            self.client.post(reverse('add_items'), {'items': items}, format='json')
+
+        Cart.objects.create(user=self.user)
+        with self.assertNumQueries(8):
+            add(self.products[:1])
+        with self.assertNumQueries(8):
+            add(self.products)
+
+
+class CartSummaryTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.first = make_product(price='10.00')
+        self.second = make_product(price='2.50')
+
+    def summary(self):
+        return self.client.get(reverse('cart_summary')).data
+
+    def test_summary_tracks_cart_writes(self):
+        self.assertEqual(self.summary()['item_count'], 0)
+        self.client.post(reverse('add_item'), {'product_id': self.first.pk, 'quantity': 2})
+        self.client.post(reverse('add_items'), {'items': [
+            {'product_id': self.first.pk},
+            {'product_id': self.second.pk, 'quantity': 2},
+        ]}, format='json')
+        self.client.post(reverse('make_order'), {'product_id': self.second.pk})
+
+        with self.assertNumQueries(1):
+            summary = self.summary()
+        self.assertEqual(summary['item_count'], 5)
+        self.assertEqual(summary['subtotal'], '35.00')
+
+        item = CartItem.objects.get(product=self.first)
+        self.client.patch(reverse('update_item', args=[item.pk]), {'quantity': 1})
+        self.assertEqual(self.summary()['subtotal'], '15.00')
+        self.client.delete(reverse('update_item', args=[item.pk]))
+        self.assertEqual((self.summary()['item_count'], self.summary()['subtotal']), (2, '5.00'))
+
+        self.client.post(reverse('checkout'))
+        self.assertEqual((self.summary()['item_count'], self.summary()['subtotal']), (0, '0.00'))
+
+    def test_other_users_lines_are_not_found(self):
+        add_to_cart(self.admin, [(self.first.pk, 1)])
+        item = CartItem.objects.get()
+        response = self.client.patch(reverse('update_item', args=[item.pk]), {'quantity': 5})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_updates_change_only_the_quantity(self):
+        add_to_cart(self.user, [(self.first.pk, 1), (self.second.pk, 1)])
+        item = CartItem.objects.get(product=self.first)
+        url = reverse('update_item', args=[item.pk])
+
+        response = self.client.patch(url, {'product_id': self.second.pk, 'quantity': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['product']['id'], self.first.pk)
+        response = self.client.patch(url, {'quantity': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual((self.summary()['item_count'], self.summary()['subtotal']), (3, '22.50'))
+
+    def test_price_change_reprices_carts(self):
+        add_to_cart(self.user, [(self.first.pk, 3)])
+        self.first.price = Decimal('1.00')
+        self.first.save()
+        self.assertEqual(self.summary()['subtotal'], '3.00')
+
+    def test_only_price_changes_reprice_carts(self):
+        add_to_cart(self.user, [(self.first.pk, 1)])
+        self.first.stock = 3
+        with self.assertNumQueries(2):  # the old price, the save
+            self.first.save()
+        with self.assertNumQueries(1):
+            self.first.save(update_fields=['stock'])
+
+    def test_deleted_product_leaves_the_summary(self):
+        add_to_cart(self.user, [(self.first.pk, 2), (self.second.pk, 1)])
+        self.first.delete()
+        self.assertEqual((self.summary()['item_count'], self.summary()['subtotal']), (1, '2.50'))
+
+    def test_rebuild_cart_summaries(self):
+        add_to_cart(self.user, [(self.first.pk, 1), (self.second.pk, 2)])
+        Cart.objects.update(item_count=7, subtotal='1.00')
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_cart_summaries', '--dry-run', stdout=StringIO())
+        call_command('rebuild_cart_summaries', stdout=StringIO())
+
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.item_count, cart.subtotal), (3, Decimal('15.00')))
+        call_command('rebuild_cart_summaries', '--dry-run', stdout=StringIO())
+
+
+class OrderTotalTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_total_tracks_line_changes(self):
+        first = make_product(price='10.00')
+        second = make_product(price='2.50')
+
+        self.client.post(reverse('make_order'), {'product_id': first.pk})
+        self.client.post(reverse('make_order'), {'product_id': second.pk})
+        self.client.post(reverse('add_item'), {'product_id': first.pk, 'quantity': 2})
+        self.client.post(reverse('make_order'), {'product_id': first.pk})
+
+        order = Order.objects.get(user=self.user, status='Pending')
+        self.assertEqual(order.total_amount, Decimal('32.50'))
+
+    def test_check_order_totals(self):
+        product = make_product(price='4.00')
+        order = Order.objects.create(user=self.user, total_amount='1.00')
+        OrderItem.objects.create(order=order, product=product, quantity=2, price='8.00')
+        Order.objects.create(user=self.user, total_amount='0.00', status='Successful')
+
+        with self.assertRaises(CommandError):
+            call_command('check_order_totals', stdout=StringIO())
+
+        call_command('check_order_totals', '--fix', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, Decimal('8.00'))
+        call_command('check_order_totals', stdout=StringIO())
+
+
+class CheckoutTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def fill_cart(self, user, *lines):
+        add_to_cart(user, [(product.pk, quantity) for product, quantity in lines])
+
+    def test_checkout_converts_cart_and_reserves_stock(self):
+        first = make_product(price='10.00', stock=5)
+        second = make_product(price='1.25', stock=5)
+        self.fill_cart(self.user, (first, 2), (second, 4))
+
+        response = self.client.post(reverse('checkout'))
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['total_amount'], '25.00')
+        self.assertEqual(len(response.data['items']), 2)
+        self.assertEqual(dict(Product.objects.values_list('pk', 'stock')), {first.pk: 3, second.pk: 1})
+        self.assertFalse(CartItem.objects.exists())
+        self.assertIsNotNone(Order.objects.get(pk=response.data['id']).reserved_at)
+
+        response = self.client.post(reverse('checkout'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_checkout_never_oversells(self):
+        hot = make_product(stock=5)
+        other = make_product(stock=5)
+        self.fill_cart(self.user, (hot, 3))
+        self.fill_cart(self.admin, (other, 1), (hot, 3))
+
+        self.assertEqual(self.client.post(reverse('checkout')).status_code, status.HTTP_201_CREATED)
+        self.client.force_authenticate(self.admin)
+        response = self.client.post(reverse('checkout'))
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['product_ids'], [hot.pk])
+        # the whole checkout rolled back, including the product that had stock
+        self.assertEqual(dict(Product.objects.values_list('pk', 'stock')), {hot.pk: 2, other.pk: 5})
+        self.assertEqual(CartItem.objects.filter(cart__user=self.admin).count(), 2)
+
+    def test_release_stock(self):
+        product = make_product(stock=5)
+        self.fill_cart(self.user, (product, 2))
+        order = Order.objects.get(pk=self.client.post(reverse('checkout')).data['id'])
+
+        release_stock(order)
+        release_stock(order)
+
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 5)
+        self.assertIsNone(order.reserved_at)
+
+
+class InventoryTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.hot = make_product(stock=10)
+        self.other = make_product(stock=5)
+        inventory.shard_stock(self.hot.pk, 3)
+
+    def shards(self):
+        return list(StockShard.objects.filter(product=self.hot).order_by('shard').values_list('quantity', flat=True))
+
+    def test_sharding_keeps_availability(self):
+        self.assertEqual(self.shards(), [4, 3, 3])
+        self.assertEqual(Product.objects.get(pk=self.hot.pk).stock, 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(inventory.available([self.hot.pk, self.other.pk]), {self.hot.pk: 10, self.other.pk: 5})
+
+        response = self.client.get(reverse('product_availability', args=[self.hot.pk]))
+        self.assertEqual(response.data, {'product_id': self.hot.pk, 'available': 10})
+        response = self.client.get(reverse('product_availability', args=[999]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        call_command('shard_stock', self.hot.pk, '--shards', '0', stdout=StringIO())
+        self.assertEqual(self.shards(), [])
+        self.assertEqual(Product.objects.get(pk=self.hot.pk).stock, 10)
+
+    def test_stock_in_the_product_row_is_still_sold(self):
+        # e.g. a restock through the Django admin
+        Product.objects.filter(pk=self.hot.pk).update(stock=4)
+        self.assertEqual(inventory.available([self.hot.pk]), {self.hot.pk: 14})
+        with transaction.atomic():
+            self.assertEqual(inventory.take({self.hot.pk: 13}), [])
+        self.assertEqual(inventory.available([self.hot.pk]), {self.hot.pk: 1})
+        self.assertEqual(Product.objects.get(pk=self.hot.pk).stock, 1)
+
+    def test_api_reads_and_writes_the_total(self):
+        url = reverse('product_detail', args=[self.hot.pk])
+        self.assertEqual(self.client.get(url).data['stock'], 10)
+        listed = {row['id']: row['stock'] for row in self.client.get(reverse('products')).data['results']}
+        self.assertEqual(listed, {self.hot.pk: 10, self.other.pk: 5})
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.patch(url, {'stock': 6}, format='json')
+        self.assertEqual(response.data['stock'], 6)
+        self.assertEqual(self.shards(), [2, 2, 2])
+        self.assertEqual(Product.objects.get(pk=self.hot.pk).stock, 0)
+
+        add_to_cart(self.user, [(self.hot.pk, 6)])
+        checkout(self.user)
+        self.assertEqual(inventory.available([self.hot.pk]), {self.hot.pk: 0})
+
+    def test_list_reads_the_total_without_per_row_queries(self):
+        for _ in range(3):
+            inventory.shard_stock(make_product(stock=6).pk, 2)
+        with self.assertNumQueries(1):
+            listed = self.client.get(reverse('products')).data['results']
+        self.assertEqual(sorted(row['stock'] for row in listed), [5, 6, 6, 6, 10])
+
+    def test_selling_from_shards_changes_validators(self):
+        url = reverse('product_detail', args=[self.hot.pk])
+        product = self.client.get(url)
+        add_to_cart(self.user, [(self.hot.pk, 1)])
+        cart = self.client.get(reverse('cart_detail'))
+
+        with transaction.atomic():
+            self.assertEqual(inventory.take({self.hot.pk: 2}), [])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=product['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['stock'], 8)
+        response = self.client.get(reverse('cart_detail'), HTTP_IF_NONE_MATCH=cart['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['items'][0]['product']['stock'], 8)
+
+    async def test_async_cart_serializes_the_total(self):
+        await sync_to_async(add_to_cart)(self.user, [(self.hot.pk, 1)])
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        response = await self.async_client.get(reverse('async_cart_detail'), headers=headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['items'][0]['product']['stock'], 10)
+
+    def test_export_and_import_carry_the_total(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = f"{tmp.name}/products.jsonl"
+        call_command('export_products', path, stdout=StringIO())
+        self.assertIn('"stock": 10', open(path).read())
+
+        with open(path, 'w') as f:
+            f.write(json.dumps({
+                'id': self.hot.pk, 'name': 'Hot', 'description': 'd', 'price': '1.00', 'category': 'c', 'stock': 7,
+            }) + '\n')
+        call_command('import_products', path, stdout=StringIO())
+        self.assertEqual(inventory.available([self.hot.pk]), {self.hot.pk: 7})
+        self.assertEqual(self.shards(), [3, 2, 2])
+
+    def test_take_spills_across_shards_and_never_oversells(self):
+        with transaction.atomic():
+            self.assertEqual(inventory.take({self.hot.pk: 2, self.other.pk: 5}), [])
+        with transaction.atomic():
+            self.assertEqual(inventory.take({self.hot.pk: 7}), [])
+        self.assertEqual(sum(self.shards()), 1)
+        with transaction.atomic():
+            self.assertEqual(inventory.take({self.hot.pk: 2, self.other.pk: 1}), [self.hot.pk, self.other.pk])
+        self.assertEqual(inventory.available([self.hot.pk, self.other.pk]), {self.hot.pk: 1, self.other.pk: 0})
+
+    def test_checkout_reserves_and_releases_shards(self):
+        add_to_cart(self.user, [(self.hot.pk, 6), (self.other.pk, 1)])
+        order = checkout(self.user)
+        self.assertEqual(inventory.available([self.hot.pk, self.other.pk]), {self.hot.pk: 4, self.other.pk: 4})
+
+        add_to_cart(self.admin, [(self.hot.pk, 5)])
+        with self.assertRaises(InsufficientStock):
+            checkout(self.admin)
+
+        release_stock(order)
+        self.assertEqual(inventory.available([self.hot.pk, self.other.pk]), {self.hot.pk: 10, self.other.pk: 5})
+
+
+@override_settings(MAINTENANCE_MAX_RATE=0)
+class MaintenanceTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(stock=10)
+        self.buyers = [CustomUser.objects.create_user(username=f'buyer{i}') for i in range(3)]
+        self.long_ago = timezone.now() - timedelta(days=90)
+
+    def checked_out_order(self, user, quantity):
+        add_to_cart(user, [(self.product.pk, quantity)])
+        return checkout(user)
+
+    def test_expires_abandoned_carts(self):
+        for user in self.buyers:
+            add_to_cart(user, [(self.product.pk, 1)])
+        Cart.objects.exclude(user=self.buyers[0]).update(updated_at=self.long_ago)
+
+        results = run_maintenance(batch_size=1)
+
+        self.assertEqual(list(Cart.objects.values_list('user', flat=True)), [self.buyers[0].pk])
+        self.assertEqual(CartItem.objects.count(), 1)
+        self.assertEqual((results[1].rows, results[1].batches), (2, 2))
+
+    def test_expires_stale_pending_orders_and_releases_stock(self):
+        unpaid = self.checked_out_order(self.buyers[0], 2)
+        paid = self.checked_out_order(self.buyers[1], 3)
+        Payment.objects.create(order=paid, method='fake', transaction_id='pi_1')
+        abandoned = Order.objects.create(user=self.buyers[2])
+        fresh = self.checked_out_order(self.user, 1)
+        Order.objects.exclude(pk=fresh.pk).update(updated_at=self.long_ago)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            results = run_maintenance(batch_size=2)
+
+        self.assertFalse(Order.objects.filter(pk__in=[unpaid.pk, abandoned.pk]).exists())
+        paid.refresh_from_db()
+        self.assertEqual((paid.status, paid.reserved_at), ('Failed', None))
+        self.assertEqual(Order.objects.get(pk=fresh.pk).status, 'Pending')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 9)
+        self.assertEqual(results[0].rows, 3)
+
+        # Nothing left to do: a second run is a no-op
+        self.assertEqual(run_maintenance()[0].rows, 0)
+        call_command('sweep_abandoned', stdout=StringIO())
+
+    def deliver(self, event_type, order):
+        event = fake_event(event_type, order.pk)
+        store_event(event['id'], event['type'], event)
+        with self.captureOnCommitCallbacks(execute=True):
+            process_webhook_events()
+        order.refresh_from_db()
+
+    def test_late_success_takes_the_stock_again(self):
+        paid = self.checked_out_order(self.buyers[0], 3)
+        Payment.objects.create(order=paid, method='fake', transaction_id='pi_1')
+        late = self.checked_out_order(self.buyers[1], 4)
+        Payment.objects.create(order=late, method='fake', transaction_id='pi_2')
+        Order.objects.update(updated_at=self.long_ago)
+        run_maintenance()
+        self.assertEqual(inventory.available([self.product.pk]), {self.product.pk: 10})
+
+        self.deliver('payment_intent.succeeded', paid)
+        self.assertEqual(paid.status, 'Successful')
+        self.assertIsNotNone(paid.reserved_at)
+        self.assertFalse(paid.backordered)
+
+        # Sold to someone else in the meantime: flagged, never oversold
+        self.checked_out_order(self.user, 5)
+        self.deliver('payment_intent.succeeded', late)
+        self.assertEqual((late.status, late.reserved_at, late.backordered), ('Successful', None, True))
+        self.assertEqual(inventory.available([self.product.pk]), {self.product.pk: 2})
+
+    def test_releases_stock_still_held_by_failed_orders(self):
+        order = self.checked_out_order(self.buyers[0], 3)
+        Order.objects.filter(pk=order.pk).update(status='Failed', updated_at=self.long_ago)
+
+        self.assertEqual(run_maintenance()[0].rows, 1)
+
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.reserved_at), ('Failed', None))
+        self.assertEqual(inventory.available([self.product.pk]), {self.product.pk: 10})
+        self.assertEqual(run_maintenance()[0].rows, 0)
+
+
+@override_settings(STRIPE_ENDPOINT_SECRET='whsec_test')
+class StripeWebhookTests(ShopTestCase):
+    def post_event(self, event, secret='whsec_test'):
+        body, signature = fake_webhook_request(event, secret)
+        return self.client.generic(
+            'POST', reverse('stripe-webhook'), body,
+            content_type='application/json', HTTP_STRIPE_SIGNATURE=signature,
+        )
+
+    def test_rejects_bad_signature(self):
+        order = Order.objects.create(user=self.user)
+        response = self.post_event(fake_event('payment_intent.succeeded', order.pk), secret='whsec_other')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_events_are_queued_once_and_applied_by_the_worker(self):
+        order = Order.objects.create(user=self.user)
+        event = fake_event('payment_intent.succeeded', order.pk)
+
+        self.assertEqual(self.post_event(event).status_code, 200)
+        self.assertEqual(self.post_event(event).status_code, 200)
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'Pending')
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+        call_command('process_webhooks', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'Successful')
+        self.assertFalse(WebhookEvent.objects.filter(processed_at__isnull=True).exists())
+
+    def test_worker_applies_batches_in_bulk(self):
+        # a user has at most one pending order
+        buyers = [CustomUser.objects.create_user(username=f'buyer{i}') for i in range(11)]
+        paid = [Order.objects.create(user=buyer) for buyer in buyers[:5]]
+        failed = [Order.objects.create(user=buyer) for buyer in buyers[5:10]]
+        retried = Order.objects.create(user=buyers[10])
+        for order in paid:
+            self.post_event(fake_event('payment_intent.succeeded', order.pk))
+        for order in failed:
+            self.post_event(fake_event('payment_intent.payment_failed', order.pk))
+        self.post_event(fake_event('payment_intent.payment_failed', retried.pk))
+        self.post_event(fake_event('payment_intent.succeeded', retried.pk))
+        self.post_event(fake_event('payment_intent.succeeded', 99999))
+
+        # one claim, the paid orders' ids and lines for the sales rollups,
+        # the failed orders' ids and reservations, one update per target
+        # status, one to mark processed
+        with self.assertNumQueries(9):
+            self.assertEqual(process_webhook_events(batch_size=100), 13)
+
+        statuses = dict(Order.objects.values_list('pk', 'status'))
+        self.assertTrue(all(statuses[o.pk] == 'Successful' for o in paid))
+        self.assertTrue(all(statuses[o.pk] == 'Failed' for o in failed))
+        self.assertEqual(statuses[retried.pk], 'Successful')
+
+    def test_failed_payment_releases_reserved_stock(self):
+        product = make_product(stock=5)
+        add_to_cart(self.user, [(product.pk, 2)])
+        order = checkout(self.user)
+
+        # A redelivery under a new event id must not give the stock back twice
+        for _ in range(2):
+            self.post_event(fake_event('payment_intent.payment_failed', order.pk))
+            with self.captureOnCommitCallbacks(execute=True):
+                process_webhook_events()
+
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.reserved_at), ('Failed', None))
+        self.assertEqual(inventory.available([product.pk]), {product.pk: 5})
+
+    def test_paid_orders_are_not_failed_by_late_events(self):
+        order = Order.objects.create(user=self.user, status='Successful')
+        self.post_event(fake_event('payment_intent.payment_failed', order.pk))
+        process_webhook_events()
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'Successful')
+
+
+class SalesRollupTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.admin)
+        self.shoe = make_product(name='shoe', category='shoes', price='50.00')
+        self.boot = make_product(name='boot', category='shoes', price='80.00')
+        self.hammer = make_product(name='hammer', category='tools', price='15.00')
+        self.buyers = [CustomUser.objects.create_user(username=f'buyer{i}') for i in range(3)]
+
+    def order(self, user, *lines, day=None):
+        order = Order.objects.create(user=user)
+        if day:
+            Order.objects.filter(pk=order.pk).update(created_at=day)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, price=Decimal(product.price) * quantity)
+            for product, quantity in lines
+        ])
+        return order
+
+    def pay(self, *orders):
+        for order in orders:
+            event = fake_event('payment_intent.succeeded', order.pk)
+            store_event(event['id'], event['type'], event)
+        process_webhook_events()
+
+    def report(self, **params):
+        params = {'start': '2025-01-01', 'end': '2025-01-03', **params}
+        return self.client.get(reverse('sales_report'), params).data
+
+    def rollups(self):
+        return [
+            sorted(model.objects.values_list(*fields))
+            for model, fields in (
+                (DailySales, ('day', 'revenue', 'units', 'orders')),
+                (DailyProductSales, ('day', 'product_id', 'revenue', 'units', 'orders')),
+                (DailyCategorySales, ('day', 'category', 'revenue', 'units', 'orders')),
+            )
+        ]
+
+    def test_rollups_follow_successful_orders(self):
+        first_day = timezone.make_aware(datetime(2025, 1, 1, 12))
+        second_day = timezone.make_aware(datetime(2025, 1, 2, 12))
+        a = self.order(self.buyers[0], (self.shoe, 1), (self.boot, 1), day=first_day)
+        b = self.order(self.buyers[1], (self.shoe, 2), (self.hammer, 1), day=first_day)
+        c = self.order(self.buyers[2], (self.hammer, 3), day=second_day)
+        self.pay(a, b, c)
+        # Redelivered and unpaid orders aren't counted
+        self.pay(a)
+        self.order(self.user, (self.shoe, 5), day=first_day)
+
+        report = self.report()
+        self.assertEqual(report['totals'], {'revenue': '290.00', 'units': 8, 'orders': 3})
+        self.assertEqual([(row['day'], row['orders']) for row in report['rows']], [('2025-01-01', 2), ('2025-01-02', 1)])
+
+        rows = self.report(by='category')['rows']
+        self.assertEqual(
+            [(row['category'], row['revenue'], row['units'], row['orders']) for row in rows],
+            [('shoes', '230.00', 4, 2), ('tools', '60.00', 4, 2)],
+        )
+        rows = self.report(by='product', limit=1, end='2025-01-02')['rows']
+        self.assertEqual(rows, [{'product_id': self.shoe.pk, 'name': 'shoe', 'revenue': '150.00', 'units': 3, 'orders': 2}])
+
+        # A rebuild from history gives the very same tables
+        incremental = self.rollups()
+        call_command('rebuild_sales_rollups', '--workers', '1', '--chunk-size', '2', stdout=StringIO())
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_rebuild_keeps_sales_recorded_while_it_ran(self):
+        day = timezone.make_aware(datetime(2025, 1, 1, 12))
+        self.pay(self.order(self.buyers[0], (self.shoe, 1), day=day))
+        late = self.order(self.buyers[1], (self.boot, 2), day=day)
+
+        # Paid after the chunks were read, just before the swap
+        with mock.patch('shop.analytics.lock_rollups', side_effect=lambda: self.pay(late)):
+            call_command('rebuild_sales_rollups', '--workers', '1', '--chunk-size', '100', stdout=StringIO())
+
+        self.assertEqual(self.report()['totals'], {'revenue': '210.00', 'units': 3, 'orders': 2})
+
+    def test_reports_are_admin_only(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('sales_report'), {'start': '2025-01-01', 'end': '2025-01-02'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse('sales_report'), {'start': '2025-01-02', 'end': '2025-01-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(SHOP_INSTRUMENTATION=True)
+class InstrumentationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        registry.reset()
+
+    def test_headers_and_route_metrics(self):
+        make_product()
+        response = self.client.get(reverse('products'))
+
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertEqual(response['X-Duplicate-Queries'], '0')
+
+        self.client.force_authenticate(self.admin)
+        routes = self.client.get(reverse('metrics')).data['routes']
+        self.assertEqual(routes['GET /api/products/']['requests'], 1)
+        self.assertEqual(routes['GET /api/products/']['avg_queries'], 1)
+
+    def test_recorder_counts_duplicate_queries(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            Order.objects.count()
+            Order.objects.count()
+            Order.objects.filter(user=self.user).count()
+        self.assertEqual(recorder.count, 3)
+        self.assertEqual(recorder.duplicates, 1)
+
+    def test_metrics_are_admin_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ProductSearchTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        make_product(name='Red running shoe', description='Light trail runner', category='shoes', price='80.00')
+        make_product(name='Blue sock', description='Cotton, good for running', category='socks', price='5.00')
+        make_product(name='Running shorts', description='Breathable', category='apparel', price='30.00')
+        make_product(name='Garden hose', description='Twenty metres', category='garden', price='25.00')
+
+    def search(self, **params):
+        response = self.client.get(reverse('product_search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_ranked_prefix_search(self):
+        data = self.search(q='runn')
+        names = [p['name'] for p in data['results']]
+        self.assertEqual(data['count'], 3)
+        # name matches outrank description-only matches
+        self.assertEqual(names[-1], 'Blue sock')
+
+    def test_facets_and_filters(self):
+        data = self.search(q='running', min_price='10')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(
+            {facet['value']: facet['count'] for facet in data['facets']['category']},
+            {'shoes': 1, 'apparel': 1},
+        )
+        # the price facet ignores the price filter itself
+        self.assertEqual(sum(bucket['count'] for bucket in data['facets']['price']), 3)
+
+        data = self.search(q='running', category='socks')
+        self.assertEqual([p['name'] for p in data['results']], ['Blue sock'])
+
+    def test_index_follows_product_writes(self):
+        hose = Product.objects.get(name='Garden hose')
+        hose.name = 'Garden sprinkler'
+        with self.captureOnCommitCallbacks(execute=True):
+            hose.save()
+        self.assertEqual(self.search(q='hose')['count'], 0)
+        self.assertEqual(self.search(q='sprinkler')['count'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            hose.delete()
+        self.assertEqual(self.search(q='sprinkler')['count'], 0)
+
+    def test_fallback_matches_fts_results(self):
+        ids, count, facets = _search_fallback('running', None, Decimal('10'), None, 20, 0)
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            {facet['value']: facet['count'] for facet in facets['category']},
+            {'shoes': 1, 'apparel': 1},
+        )
+        self.assertEqual(sum(bucket['count'] for bucket in facets['price']), 3)
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self.search(q='"running" (')['count'], 3)
+        self.assertEqual(self.search(q='***')['count'], 0)
+
+
+def image_file(name='photo.png', size=(800, 500), mode='RGBA'):
+    buffer = BytesIO()
+    Image.new(mode, size, (200, 30, 30, 255) if mode == 'RGBA' else (200, 30, 30)).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class ImageDerivativeTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = self.settings(MEDIA_ROOT=media.name, IMAGE_DERIVATIVES_ASYNC=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_upload_generates_derivatives(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = make_product(image=image_file())
+
+        product.refresh_from_db()
+        self.assertEqual(product.image_derivatives['source'], product.image.name)
+        with default_storage.open(product.image_derivatives['thumbnail']['webp']) as f:
+            self.assertEqual(Image.open(f).size, (150, 150))
+        with default_storage.open(product.image_derivatives['large']['jpeg']) as f:
+            self.assertEqual(Image.open(f).size, (800, 500))
+
+        data = self.client.get(reverse('product_detail', args=[product.pk])).data
+        self.assertTrue(data['image_derivatives']['card']['webp'].startswith('http://testserver/media/derivatives/'))
+
+    def test_stored_derivatives_reach_cached_catalog_pages(self):
+        product = make_product(image=default_storage.save('cached.png', image_file()))
+        self.assertEqual(self.client.get(reverse('products')).data['results'][0]['image_derivatives'], {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            store_derivatives(product.pk, product.image.name, render_derivatives(read_source(product.image.name)))
+
+        derivatives = self.client.get(reverse('products')).data['results'][0]['image_derivatives']
+        self.assertEqual(set(derivatives), {'thumbnail', 'card', 'large'})
+
+    def test_backfill_command(self):
+        corrupt = make_product(image=default_storage.save('corrupt.png', BytesIO(b'not an image')))
+        product = make_product(image=default_storage.save('old.png', image_file()))
+        make_product(image='missing.png')
+        self.assertEqual(product.image_derivatives, {})
+
+        for workers in ('2', '0'):
+            out, err = StringIO(), StringIO()
+            call_command('generate_image_derivatives', '--workers', workers, '--force', stdout=out, stderr=err)
+
+            product.refresh_from_db()
+            self.assertEqual(set(product.image_derivatives), {'source', 'thumbnail', 'card', 'large'})
+            self.assertIn('1 products (1 skipped, 1 failed)', out.getvalue())
+            self.assertIn(f'Product {corrupt.pk} (corrupt.png)', err.getvalue())
+
+
+class ConditionalGetTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.product = make_product()
+
+    def revalidate(self, url, response, queries):
+        with self.assertNumQueries(queries):
+            return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_product_detail(self):
+        url = reverse('product_detail', args=[self.product.pk])
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+
+        self.assertEqual(self.revalidate(url, response, 1).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.product.stock = 3
+        self.product.save()
+        self.assertEqual(self.revalidate(url, response, 1).status_code, status.HTTP_200_OK)
+
+    def test_order_detail_skips_loading_items(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, quantity=1, price='10.00')
+        url = reverse('order_detail', args=[order.pk])
+        response = self.client.get(url)
+
+        # order timestamp + one aggregate over the lines, nothing else
+        self.assertEqual(self.revalidate(url, response, 2).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # product data nested in the order changed
+        Product.objects.filter(pk=self.product.pk).update(name='Renamed', updated_at=timezone.now())
+        response = self.revalidate(url, response, 4)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['items'][0]['product']['name'], 'Renamed')
+
+    def test_cart_detail_changes_with_items(self):
+        url = reverse('cart_detail')
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response, 2).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(reverse('add_item'), {'product_id': self.product.pk})
+        response = self.revalidate(url, response, 4)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['items']), 1)
+
+    def test_missing_order(self):
+        self.assertEqual(self.client.get(reverse('order_detail', args=[999])).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ProductImportExportTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def write(self, name, content):
+        path = f"{self.tmp}/{name}"
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_csv_import_creates_updates_and_reports_invalid_rows(self):
+        existing = make_product(name='Old name', price='1.00', stock=1)
+        path = self.write('products.csv', (
+            "id,name,description,price,stock,category,image\n"
+            f"{existing.pk},New name,Updated,2.50,7,tools,widget.png\n"
+            ",Lamp,Desk lamp,19.99,3,home,lamp.png\n"
+            ",Broken,No price,,3,home,\n"
+            ",Negative,Bad stock,1.00,-1,home,\n"
+        ))
+        out, err = StringIO(), StringIO()
+        call_command('import_products', path, '--batch-size', '2', stdout=out, stderr=err)
+
+        existing.refresh_from_db()
+        self.assertEqual((existing.name, existing.price, existing.stock), ('New name', Decimal('2.50'), 7))
+        self.assertTrue(Product.objects.filter(name='Lamp', price='19.99').exists())
+        self.assertIn('1 created, 1 updated, 2 invalid', out.getvalue())
+        self.assertIn('line 4: price: This field is required.', err.getvalue())
+
+    def test_jsonl_partial_rows_only_touch_given_columns(self):
+        product = make_product(name='Keep', stock=5)
+        path = self.write('products.jsonl', json.dumps({
+            'id': product.pk, 'name': 'Keep', 'description': 'd', 'price': 3.5, 'category': 'c',
+        }) + '\n')
+        call_command('import_products', path, stdout=StringIO())
+
+        product.refresh_from_db()
+        self.assertEqual((product.price, product.stock), (Decimal('3.50'), 5))
+
+    def test_repeated_ids_keep_the_last_row_and_new_ids_advance_the_sequence(self):
+        existing = make_product(name='Old')
+        rows = [
+            {'id': existing.pk, 'name': 'First', 'description': 'd', 'price': '1.00', 'category': 'c'},
+            {'id': existing.pk, 'name': 'Second', 'description': 'd', 'price': '2.00', 'category': 'c'},
+            {'id': existing.pk + 100, 'name': 'Imported', 'description': 'd', 'price': '3.00', 'category': 'c'},
+        ]
+        path = self.write('products.jsonl', ''.join(json.dumps(row) + '\n' for row in rows))
+        out = StringIO()
+        call_command('import_products', path, stdout=out)
+
+        existing.refresh_from_db()
+        self.assertEqual((existing.name, existing.price), ('Second', Decimal('2.00')))
+        self.assertIn('1 created, 1 updated, 0 invalid', out.getvalue())
+        self.assertGreater(make_product().pk, existing.pk + 100)
+
+    def test_export_round_trips(self):
+        for i in range(5):
+            make_product(name=f'p{i}', price=f'{i}.25')
+        for fmt in ('csv', 'jsonl'):
+            path = f"{self.tmp}/export.{fmt}"
+            call_command('export_products', path, '--chunk-size', '2', stdout=StringIO())
+            before = list(Product.objects.order_by('pk').values_list('name', 'price'))
+            Product.objects.all().delete()
+            call_command('import_products', path, stdout=StringIO())
+            self.assertEqual(list(Product.objects.order_by('pk').values_list('name', 'price')), before)
+
+
+class OrderExportTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.product = make_product(name='Lamp')
+        self.orders = []
+        for day in (1, 2, 3):
+            order = Order.objects.create(user=self.user, total_amount='20.00', status='Successful')
+            Order.objects.filter(pk=order.pk).update(created_at=f'2025-03-0{day}T12:00:00Z')
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, price='20.00')
+            self.orders.append(order)
+        Order.objects.create(user=self.admin)
+
+    def export(self, **params):
+        response = self.client.get(reverse('order_export'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        lines = self.export().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [o.pk for o in self.orders])
+        self.assertEqual(json.loads(lines[0])['items'][0]['product']['name'], 'Lamp')
+
+    def test_csv_with_date_range(self):
+        rows = list(csv.reader(StringIO(self.export(type='csv', start='2025-03-02', end='2025-03-03'))))
+        self.assertEqual(rows[0][0], 'order_id')
+        self.assertEqual(rows[1][:1] + rows[1][5:], [str(self.orders[1].pk), 'Lamp', '2', '20.00'])
+        self.assertEqual(len(rows), 2)
+
+    def test_query_count_is_constant(self):
+        with self.assertNumQueries(3):
+            self.export()
+
+
+class AsyncViewTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(price='12.50')
+        # Sharded, so serializing its stock would query if it weren't annotated
+        inventory.shard_stock(self.product.pk, 2)
+        self.headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        self.client.force_authenticate(self.user)
+
+    async def test_requires_a_valid_token(self):
+        response = await self.async_client.get(reverse('async_cart_detail'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = await self.async_client.get(
+            reverse('async_cart_detail'), headers={'Authorization': 'Bearer not-a-token'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_cart_and_orders_match_the_sync_views(self):
+        response = await self.async_client.post(
+            reverse('async_add_item'), {'product_id': self.product.pk, 'quantity': 2},
+            content_type='application/json', headers=self.headers,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = await self.async_client.get(reverse('async_cart_detail'), headers=self.headers)
+        expected = await sync_to_async(self.client.get)(reverse('cart_detail'))
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual(response.json()['items'][0]['quantity'], 2)
+
+        response = await self.async_client.post(reverse('async_checkout'), headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['total_amount'], '25.00')
+        order_id = response.json()['id']
+
+        response = await self.async_client.get(reverse('async_orders'), headers=self.headers)
+        expected = await sync_to_async(self.client.get)(reverse('orders'))
+        self.assertEqual(response.json(), expected.json())
+
+        response = await self.async_client.get(reverse('async_order_detail', args=[order_id]), headers=self.headers)
+        expected = await sync_to_async(self.client.get)(reverse('order_detail', args=[order_id]))
+        self.assertEqual(response.json(), expected.json())
+
+        other = await Order.objects.acreate(user=self.admin)
+        response = await self.async_client.get(reverse('async_order_detail', args=[other.pk]), headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_payment_intent_against_the_stub(self):
+        await Order.objects.acreate(user=self.user, total_amount='25.00')
+        server = make_server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        stub = override_settings(
+            PAYMENT_GATEWAY='shop.payments.StripeGateway',
+            STRIPE_API_BASE=f'http://127.0.0.1:{server.server_address[1]}',
+            STRIPE_SECRET_KEY='sk_test_stub',
+        )
+        with stub:
+            response = await self.async_client.post(reverse('async_create_payment_intent'), headers=self.headers)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertTrue(response.json()['clientSecret'].startswith('pi_stub_'))
+
+            # Served from the cached intent, so it works with the stub gone
+            server.shutdown()
+            again = await self.async_client.post(reverse('async_create_payment_intent'), headers=self.headers)
+        self.assertEqual(again.json(), response.json())
+
+
+@override_settings(PAYMENT_GATEWAY='shop.payments.FakeGateway')
+class PaymentIntentTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.order = Order.objects.create(user=self.user, total_amount='25.00')
+        get_gateway.cache_clear()  # a fresh FakeGateway per test
+        self.gateway = get_gateway()
+
+    def pay(self):
+        response = self.client.post(reverse('create-payment-intent'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['clientSecret']
+
+    def test_intent_is_created_once_per_order(self):
+        secret = self.pay()
+
+        intent, = self.gateway.intents.values()
+        self.assertEqual(intent.amount, 2500)
+        self.assertEqual(intent.metadata['order_id'], self.order.pk)
+
+        with self.assertNumQueries(2):  # the order and its cached payment
+            self.assertEqual(self.pay(), secret)
+        self.assertEqual(self.gateway.calls, 1)
+        self.assertEqual(Payment.objects.get().transaction_id, intent.id)
+
+    def test_changed_total_updates_the_same_intent(self):
+        secret = self.pay()
+        Order.objects.filter(pk=self.order.pk).update(total_amount='30.50')
+
+        self.assertEqual(self.pay(), secret)
+        self.assertEqual(self.gateway.calls, 2)
+        intent, = self.gateway.intents.values()
+        self.assertEqual(intent.amount, 3050)
+        self.assertEqual(Payment.objects.get().amount, 3050)
+
+    def test_each_update_gets_its_own_idempotency_key(self):
+        self.pay()
+        for total in ('30.50', '25.00', '30.50'):
+            Order.objects.filter(pk=self.order.pk).update(total_amount=total)
+            self.pay()
+
+        intent, = self.gateway.intents.values()
+        self.assertEqual((intent.amount, Payment.objects.get().amount), (3050, 3050))
+        self.assertEqual(self.gateway.calls, 4)
+
+    def test_fake_gateway_replays_reused_keys(self):
+        intent = self.gateway.create_intent(100, {}, 'create-key')
+        self.gateway.update_intent(intent.id, 200, 'update-key')
+        replayed = self.gateway.update_intent(intent.id, 300, 'update-key')
+        self.assertEqual((replayed.amount, intent.amount), (200, 200))
+
+    def test_requires_a_pending_total(self):
+        Order.objects.filter(pk=self.order.pk).update(total_amount='0.00')
+        response = self.client.post(reverse('create-payment-intent'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.gateway.calls, 0)
+
+
+class CachedJWTAuthenticationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        token_cache.clear()
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=make_product(), quantity=1)
+        self.token = AccessToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+
+    def test_repeat_requests_make_no_auth_queries(self):
+        budget = NestedReadQueryBudgetTests.CART_DETAIL_QUERIES
+        with self.assertNumQueries(budget + 1):
+            self.client.get(reverse('cart_detail'))
+        with self.assertNumQueries(budget):
+            response = self.client.get(reverse('cart_detail'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_user_changes_are_seen_immediately(self):
+        self.client.get(reverse('cart_detail'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        response = self.client.get(reverse('cart_detail'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        response = self.client.get(reverse('cart_detail'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(AUTH_TOKEN_CACHE_SIZE=2)
+    def test_token_cache_is_bounded_and_drops_expired_tokens(self):
+        tokens = [AccessToken.for_user(self.user) for _ in range(3)]
+        raw = [str(token) for token in tokens]
+        for raw_token, token in zip(raw, tokens):
+            token_cache.set(raw_token, token)
+        self.assertEqual(len(token_cache), 2)
+        self.assertIsNone(token_cache.get(raw[0]))
+
+        tokens[2]['exp'] = int(time.time()) - 1
+        self.assertIsNone(token_cache.get(raw[2]))
+        self.assertIs(token_cache.get(raw[1]), tokens[1])
+
+
+class BenchmarkOptionsTests(ShopTestCase):
+    def test_rejects_an_empty_catalog_or_user_base(self):
+        for option in ('--products', '--users'):
+            with self.assertRaisesMessage(CommandError, f'{option} must be at least 1'):
+                call_command('benchmark', option, '0', stdout=StringIO())
+
+    def test_bulk_adds_fit_a_small_catalog(self):
+        build = next(builder for name, _, builder in ENDPOINTS if name == 'add_items')
+        scenario = Scenario([make_product().pk for _ in range(2)], [self.user], {})
+        _, _, body, _ = build(scenario, random.Random(0))
+        self.assertEqual(len(body['items']), 2)
@@ -0,0 +1,11 @@
+"""Small helpers shared by the batch jobs (recommendations, analytics)."""
+
+# Keeps IN (...) lists under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+def chunked(values, size=CHUNK_SIZE):
+    """Yield ``values`` as lists of at most ``size`` items."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
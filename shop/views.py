@@ -1,61 +1,54 @@
+import json
 import stripe
-import os
+from decimal import Decimal
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Prefetch, Sum, prefetch_related_objects
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework import generics, permissions, status
 from rest_framework.permissions import AllowAny
 from django.contrib.auth import get_user_model
 from rest_framework.response import Response
-from .serializers import RegisterSerializer, ProductSerializer, OrderItemSerializer, OrderSerializer, CartItemSerializer, CartSerializer
-from .models import IsAdminUser, Product, OrderItem, Order, Cart, CartItem
+from rest_framework.generics import get_object_or_404
+from .serializers import RegisterSerializer, UserListSerializer, ProductSerializer, OrderItemSerializer, OrderSerializer, CartItemSerializer, CartItemUpdateSerializer, CartSerializer, CartSummarySerializer, CartLineSerializer, CartBulkAddSerializer, ProductSearchSerializer, OrderExportSerializer, SalesReportQuerySerializer, SalesReportRowSerializer, SalesTotalsSerializer
+from .models import IsAdminUser, Product, OrderItem, Order, Cart, CartItem, DailySales, DailyProductSales, DailyCategorySales
+from . import inventory
+from .cart import UnknownProducts, add_to_cart, adjust_summary
+from .checkout import EmptyCart, InsufficientStock, OrderAlreadyReserved, checkout
+from .cache import catalog_cache_key
+from .conditional import ConditionalGetMixin, items_version, make_etag
+from .exports import csv_lines, ndjson_lines
+from .instrumentation import registry
+from .pagination import ProductCursorPagination, UserCursorPagination
+from .payments import PaymentGatewayError, payment_intent_for
+from .search import search_products
+from .webhooks import store_event
 
 User = get_user_model()
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
-
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
-endpoint_secret = os.getenv("STRIPE_ENDPOINT_SECRET")  # from Stripe dashboard
 
 @csrf_exempt
 def stripe_webhook(request):
     payload = request.body
-    sig_header = request.META['HTTP_STRIPE_SIGNATURE']
+    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
 
     try:
         # Verify webhook signature
         event = stripe.Webhook.construct_event(
-            payload, sig_header, endpoint_secret
+            payload, sig_header, settings.STRIPE_ENDPOINT_SECRET
         )
     except ValueError:
         return HttpResponse(status=400)  
     except stripe.error.SignatureVerificationError:
         return HttpResponse(status=400)  # Invalid signature
 
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        order_id = payment_intent['metadata'].get('order_id')  # we’ll pass this when creating intent
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.status = "Successful"
-                order.save()
-                print(f"Order {order.id} marked as Successful")
-            except Order.DoesNotExist:
-                print(" Order not found")
-
-    elif event['type'] == 'payment_intent.payment_failed':
-        payment_intent = event['data']['object']
-        order_id = payment_intent['metadata'].get('order_id')
-        if order_id:
-            try:
-                order = Order.objects.get(id=order_id)
-                order.status = "Failed"
-                order.save()
-                print(f"Order {order.id} marked as Failed")
-            except Order.DoesNotExist:
-                print("Order not found")
-
+    # Only queue the event here; `manage.py process_webhooks` applies it.
+    # Stripe redelivers on timeouts, so acknowledging fast matters and the
+    # unique event id makes retries harmless.
+    store_event(event['id'], event['type'], json.loads(payload))
     return HttpResponse(status=200)
 
 #-------------------------------------------------------------------------------------------
@@ -64,73 +57,283 @@ class RegisterView(generics.CreateAPIView):
     permission_classes = (AllowAny,)
     serializer_class = RegisterSerializer
 
+def prefix_range(field, prefix):
+    """Lookups matching values that start with ``prefix``, as an index range scan.
+
+    ``startswith`` becomes LIKE, which SQLite won't serve from an index
+    since its LIKE ignores case; a range over the same prefix will.
+    """
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return {f'{field}__gte': prefix, f'{field}__lt': upper}
+
+
 class UserListView(generics.ListAPIView):
-    queryset = User.objects.all()
-    serializer_class = RegisterSerializer
+    serializer_class = UserListSerializer
+    permission_classes = [IsAdminUser]
+    pagination_class = UserCursorPagination
+
+    def get_queryset(self):
+        # Only the listed columns: no password hashes or permission fields
+        users = User.objects.values(*UserListSerializer.Meta.fields)
+        for field in ('username', 'email'):
+            prefix = self.request.query_params.get(field)
+            if prefix:
+                users = users.filter(**prefix_range(field, prefix))
+        return users
+
+class InstrumentationMetricsView(APIView):
     permission_classes = [IsAdminUser]
 
+    def get(self, request):
+        return Response({
+            "enabled": settings.SHOP_INSTRUMENTATION,
+            "routes": registry.snapshot(),
+        })
+
+    def delete(self, request):
+        registry.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class SalesReportView(APIView):
+    """Revenue, units and orders over ``[start, end)`` by day, product or category.
+
+    Answered from the daily rollups (see shop.analytics), so the cost
+    depends on the length of the range, not on the number of orders.
+    """
+    permission_classes = [IsAdminUser]
+    reports = {
+        'day': (DailySales, ['day']),
+        'product': (DailyProductSales, ['product_id', 'product__name']),
+        'category': (DailyCategorySales, ['category']),
+    }
+
+    def get(self, request):
+        params = SalesReportQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        start, end, by = params.validated_data['start'], params.validated_data['end'], params.validated_data['by']
+        totals = {'revenue': Sum('revenue'), 'units': Sum('units'), 'orders': Sum('orders')}
+
+        model, keys = self.reports[by]
+        rows = model.objects.filter(day__gte=start, day__lt=end).values(*keys).annotate(**totals)
+        if by == 'day':
+            rows = rows.order_by('day')
+        else:
+            rows = rows.order_by('-revenue', *keys)[:params.validated_data['limit']]
+
+        # Per-day totals count each order once, whatever it contained
+        overall = DailySales.objects.filter(day__gte=start, day__lt=end).aggregate(**totals)
+        return Response({
+            "start": start,
+            "end": end,
+            "by": by,
+            "totals": SalesTotalsSerializer({key: value or 0 for key, value in overall.items()}).data,
+            "rows": SalesReportRowSerializer(rows, many=True).data,
+        })
+
 #----------------------------- PRODUCT ENDPOINTS-------------------------------------------
 
 class ProductListCreateView(generics.ListCreateAPIView):
-    queryset = Product.objects.all()
+    queryset = inventory.with_available_stock()
     serializer_class = ProductSerializer
+    pagination_class = ProductCursorPagination
+
     def get_permissions(self):
         if self.request.method == 'POST':
             return [permissions.IsAdminUser()]
         return [permissions.AllowAny()]
+
+    def list(self, request, *args, **kwargs):
+        # Resolve the key before querying so a write that lands mid-request
+        # can only ever populate a version nobody reads anymore.
+        key = catalog_cache_key(request)
+        data = cache.get(key)
+        if data is None:
+            data = super().list(request, *args, **kwargs).data
+            cache.set(key, data, timeout=settings.CATALOG_CACHE_TIMEOUT)
+        return Response(data)
     
 
-class ProductDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Product.objects.all()
+class ProductSearchView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        params = ProductSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        # Same versioned cache as the catalog list, so admin writes invalidate it
+        key = catalog_cache_key(request)
+        data = cache.get(key)
+        if data is None:
+            filters = dict(params.validated_data)
+            products, count, facets = search_products(connection, filters.pop('q'), **filters)
+            data = {
+                "count": count,
+                "results": ProductSerializer(products, many=True, context={'request': request}).data,
+                "facets": facets,
+            }
+            cache.set(key, data, timeout=settings.CATALOG_CACHE_TIMEOUT)
+        return Response(data)
+
+class ProductDetailView(ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = inventory.with_available_stock()
     serializer_class = ProductSerializer
 
+    def get_validators(self):
+        # The row is the whole response, so load it once and keep it for
+        # serialization rather than querying twice.
+        self._object = super().get_object()
+        # Sales from shards don't touch updated_at (that would put every
+        # buyer back on the product row), so the stock is part of the tag
+        etag = make_etag(self._object.pk, self._object.updated_at, self._object.available_stock)
+        return etag, self._object.updated_at
+
+    def get_object(self):
+        if hasattr(self, '_object'):
+            return self._object
+        return super().get_object()
+
     def get_permissions(self):
         if self.request.method in ['PUT', 'PATCH', 'DELETE']:
             return [IsAdminUser()]  # only admins can modify
         return [permissions.AllowAny()]
+
+
+class ProductRelatedView(generics.ListAPIView):
+    """Products often bought together with this one, best first (see shop.recommendations)."""
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.AllowAny]
+    pagination_class = None
+
+    def get_queryset(self):
+        # One query through the (product, rank) index, joined to the products
+        return (
+            inventory.with_available_stock()
+            .filter(recommended_with__product_id=self.kwargs['pk'])
+            .order_by('recommended_with__rank')
+        )
+
+
+class ProductAvailabilityView(APIView):
+    """Units available right now, stock shards included (see shop.inventory)."""
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, pk):
+        available = inventory.available([pk])
+        if pk not in available:
+            return Response({"detail": "No Product matches the given query."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"product_id": pk, "available": available[pk]})
     
 #----------------------------- CART ENDPOINTS-------------------------------------------
 
-class CartDetailView(generics.RetrieveAPIView):
+def cart_items_prefetch():
+    return Prefetch('cartitem_set', queryset=CartItem.objects.prefetch_related(inventory.product_prefetch()))
+
+
+def order_items_prefetch():
+    return Prefetch('orderitem_set', queryset=OrderItem.objects.prefetch_related(inventory.product_prefetch()))
+
+
+class CartDetailView(ConditionalGetMixin, generics.RetrieveAPIView):
     serializer_class = CartSerializer
-    permission_class = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_validators(self):
+        self._cart, created = Cart.objects.get_or_create(user=self.request.user)
+        lines, shard_stock, products_updated = items_version(self._cart.cartitem_set.all())
+        etag = make_etag(self._cart.pk, self._cart.updated_at, lines, shard_stock, products_updated)
+        return etag, max(filter(None, [self._cart.updated_at, products_updated]))
 
     def get_object(self):
-        cart, created = Cart.objects.get_or_create(user=self.request.user)
+        cart = self._cart
+        prefetch_related_objects([cart], cart_items_prefetch())
         return cart
     
 class CartItemCreateView(generics.CreateAPIView):
     serializer_class = CartItemSerializer
-    permission_class = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated]
 
     def create(self, request):
-        cart, _ = Cart.objects.get_or_create(user=self.request.user)
+        line = CartLineSerializer(data=request.data)
+        line.is_valid(raise_exception=True)
 
         try:
-            product = Product.objects.get(id=request.data.get('product_id'))
-        except Product.DoesNotExist:
-            return Response({"error": "No product with this id"})
-        
-        cart_item, _ = CartItem.objects.get_or_create(cart=cart, product=product)
-        cart_item.quantity += int(request.data.get('quantity', 1))
-        cart_item.save()
+            _, items = add_to_cart(request.user, [(line.validated_data['product_id'], line.validated_data['quantity'])])
+        except UnknownProducts:
+            return Response({"error": "No product with this id"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            CartItemSerializer(items[0], context={'request': request}).data,
+            status=status.HTTP_201_CREATED
+        )
+
+class CartItemBulkCreateView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        basket = CartBulkAddSerializer(data=request.data)
+        basket.is_valid(raise_exception=True)
+        lines = [(item['product_id'], item['quantity']) for item in basket.validated_data['items']]
+
+        try:
+            _, items = add_to_cart(request.user, lines)
+        except UnknownProducts as e:
+            return Response(
+                {"error": "No product with this id", "product_ids": e.product_ids},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
         return Response(
-            CartItemSerializer(cart_item).data,
+            CartItemSerializer(items, many=True, context={'request': request}).data,
             status=status.HTTP_201_CREATED
         )
 
     
+class CartSummaryView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        # The maintained aggregates only: one indexed lookup, no items
+        summary = (
+            Cart.objects.filter(user=request.user)
+            .values('item_count', 'subtotal', 'updated_at')
+            .first()
+        )
+        return Response(CartSummarySerializer(summary or {'item_count': 0, 'subtotal': 0, 'updated_at': None}).data)
+
+
 class CartItemDetailView(generics.RetrieveUpdateDestroyAPIView):
-    serializer_class = CartItemSerializer
-    permission_class = [permissions.IsAuthenticated]
+    serializer_class = CartItemUpdateSerializer
+    permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return CartItem.objects.filter(cart_user=self.request.user)
+        items = CartItem.objects.filter(cart__user=self.request.user).prefetch_related(inventory.product_prefetch())
+        if self.request.method not in permissions.SAFE_METHODS:
+            # Locked until the cart summary has been adjusted
+            items = items.select_for_update(of=('self',))
+        return items
+
+    @transaction.atomic
+    def update(self, request, *args, **kwargs):
+        return super().update(request, *args, **kwargs)
+
+    @transaction.atomic
+    def destroy(self, request, *args, **kwargs):
+        return super().destroy(request, *args, **kwargs)
+
+    def perform_update(self, serializer):
+        old_quantity, old_total = serializer.instance.quantity, serializer.instance.line_total()
+        item = serializer.save()
+        adjust_summary(item.cart_id, items=item.quantity - old_quantity, amount=item.line_total() - old_total)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        adjust_summary(instance.cart_id, items=-instance.quantity, amount=-instance.line_total())
 #----------------------------- ORDER ENDPOINTS-------------------------------------------
 class OrderItemCreateView(generics.CreateAPIView):
     serializer_class = OrderItemSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    @transaction.atomic
     def create(self, request, *args, **kwargs):
         user = self.request.user
 
@@ -138,11 +341,13 @@ class OrderItemCreateView(generics.CreateAPIView):
         cart, _ = Cart.objects.get_or_create(user=user)
 
         # Always tie new items to a "Pending" order
-        order, created_now = Order.objects.get_or_create(user=user, status="Pending")
+        order, created_now = Order.objects.select_for_update().get_or_create(user=user, status="Pending")
+        if order.reserved_at:
+            return Response({"error": "Order is already checked out"}, status=status.HTTP_409_CONFLICT)
 
         # Check product exists
         try:
-            product = Product.objects.get(id=request.data.get("product_id"))
+            product = inventory.with_available_stock().get(id=request.data.get("product_id"))
         except Product.DoesNotExist:
             return Response({"error": "No product with this id"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -150,6 +355,7 @@ class OrderItemCreateView(generics.CreateAPIView):
         cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
         if created:
             cart_item.quantity = 1
+            adjust_summary(cart.pk, items=1, amount=product.price)
         cart_item.save()
 
         # Calculate price for this order item
@@ -157,58 +363,111 @@ class OrderItemCreateView(generics.CreateAPIView):
 
         # If order item already exists, update instead of creating duplicate
         order_item, created_item = OrderItem.objects.get_or_create(order=order, product=product)
+        previous_price = Decimal(0) if created_item else order_item.price
 
         order_item.quantity = cart_item.quantity
         order_item.price = price
         order_item.save()
 
-        # Update total amount
-        order.total_amount = sum(item.price for item in order.orderitem_set.all())
-        order.save()
+        # Apply only this line's change to the total instead of re-summing the order
+        Order.objects.filter(pk=order.pk).update(
+            total_amount=F('total_amount') + (price - previous_price), updated_at=timezone.now()
+        )
 
         return Response(
             OrderItemSerializer(order_item).data,
             status=status.HTTP_201_CREATED,
         )
     
+class CheckoutView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        try:
+            order = checkout(request.user)
+        except EmptyCart as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except OrderAlreadyReserved as e:
+            return Response({"error": str(e), "order_id": e.order.pk}, status=status.HTTP_409_CONFLICT)
+        except InsufficientStock as e:
+            return Response({"error": str(e), "product_ids": e.product_ids}, status=status.HTTP_409_CONFLICT)
+
+        order = Order.objects.prefetch_related(order_items_prefetch()).get(pk=order.pk)
+        return Response(OrderSerializer(order, context={'request': request}).data, status=status.HTTP_201_CREATED)
+
 class OrderListView(generics.ListAPIView):
     serializer_class = OrderSerializer
-    permission_class = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user)
+        return Order.objects.filter(user=self.request.user).prefetch_related(order_items_prefetch())
+
+class OrderExportView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    chunk_size = 500
+
+    def get(self, request):
+        params = OrderExportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        filters = params.validated_data
+
+        orders = Order.objects.filter(user=request.user)
+        if 'start' in filters:
+            orders = orders.filter(created_at__gte=filters['start'])
+        if 'end' in filters:
+            orders = orders.filter(created_at__lt=filters['end'])
+        # Walks the (user, created_at) index and pulls items chunk by chunk,
+        # so memory stays flat however many orders the account has.
+        orders = (
+            orders.order_by('created_at', 'pk')
+            .prefetch_related(order_items_prefetch())
+            .iterator(chunk_size=self.chunk_size)
+        )
 
-class OrderDetailView(generics.RetrieveAPIView):
+        if filters['type'] == 'csv':
+            response = StreamingHttpResponse(csv_lines(orders), content_type='text/csv')
+            filename = 'orders.csv'
+        else:
+            response = StreamingHttpResponse(
+                ndjson_lines(orders, {'request': request}), content_type='application/x-ndjson'
+            )
+            filename = 'orders.ndjson'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+class OrderDetailView(ConditionalGetMixin, generics.RetrieveAPIView):
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user)
+        return Order.objects.filter(user=self.request.user).prefetch_related(order_items_prefetch())
 
-#------------------------------------------------------------------------------------------
+    def get_validators(self):
+        # The order row plus an aggregate over its lines; the items
+        # themselves are loaded only when the client is out of date.
+        self._order = get_object_or_404(Order.objects.filter(user=self.request.user), pk=self.kwargs['pk'])
+        lines, shard_stock, products_updated = items_version(self._order.orderitem_set.all())
+        etag = make_etag(self._order.pk, self._order.updated_at, lines, shard_stock, products_updated)
+        return etag, max(filter(None, [self._order.updated_at, products_updated]))
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+    def get_object(self):
+        prefetch_related_objects([self._order], order_items_prefetch())
+        return self._order
+
+#------------------------------------------------------------------------------------------
 
 class CreateStripePaymentIntent(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request):
-        try:
-            # Example: total from request payload
-            #amount = request.data.get("amount")  # in cents, e.g. 2000 = $20
-            amount = request.user.order_set.filter(status="Pending").first().total_amount 
-            if not amount:
-                return Response({"error": "Amount is required"}, status=status.HTTP_400_BAD_REQUEST)
-
-            intent = stripe.PaymentIntent.create(
-                amount=int(amount),
-                currency="usd",
-                automatic_payment_methods={"enabled": True},
-                metadata={"user_id": request.user.id}  # optional
-            )
+        order = request.user.order_set.filter(status="Pending").first()
+        if order is None or not order.total_amount:
+            return Response({"error": "Amount is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-            return Response({
-                "clientSecret": intent["client_secret"]
-            }, status=status.HTTP_201_CREATED)
+        try:
+            client_secret = payment_intent_for(order)
+        except PaymentGatewayError as e:
+            return Response({"error": str(e)}, status=status.HTTP_502_BAD_GATEWAY)
 
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return Response({
+            "clientSecret": client_secret
+        }, status=status.HTTP_201_CREATED)
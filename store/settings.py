@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost so it sees every query; removes itself unless SHOP_INSTRUMENTATION is set
+    'shop.middleware.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,6 +55,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-request query/timing instrumentation (Server-Timing headers and
+# /api/admin/metrics/). Off by default.
+SHOP_INSTRUMENTATION = os.getenv('SHOP_INSTRUMENTATION', 'False').lower() in ('1', 'true', 'yes')
+
 ROOT_URLCONF = 'store.urls'
 
 TEMPLATES = [
@@ -75,13 +82,83 @@ WSGI_APPLICATION = 'store.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
+# Configured from the environment. DB_ENGINE picks the backend:
+#   sqlite (default)  DB_NAME is the file path
+#   postgresql        DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT;
+#                     DB_POOL=True uses psycopg's connection pool
+#                     (pip install "psycopg[binary,pool]")
+# Connections are kept open for DB_CONN_MAX_AGE seconds and health-checked
+# before reuse.
+
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 60))
+
+if DB_ENGINE == 'postgresql':
+    DB_POOL = os.getenv('DB_POOL', 'False').lower() in ('1', 'true', 'yes')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'store'),
+            'USER': os.getenv('DB_USER', 'postgres'),
+            'PASSWORD': os.getenv('DB_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            # The pool owns connection lifetime; Django refuses both at once
+            'CONN_MAX_AGE': 0 if DB_POOL else DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 20)),
+                    'timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+                },
+            } if DB_POOL else {},
+        }
+    }
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Wait for the write lock instead of failing with
+                # "database is locked"
+                'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 20)),
+                # Take the write lock when the transaction starts, so two
+                # readers never deadlock trying to upgrade to writers
+                'transaction_mode': 'IMMEDIATE',
+                # WAL lets readers run alongside the writer; NORMAL sync is
+                # durable across app crashes and much cheaper per commit
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', 268435456))};"
+                    'PRAGMA cache_size=-32000;'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unsupported DB_ENGINE {DB_ENGINE!r}; use 'sqlite' or 'postgresql'")
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'shop'),
     }
 }
 
+# Seconds a rendered product list page may be served from cache. Admin
+# writes bump the catalog version, so this only bounds memory, not staleness.
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 300))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -119,6 +196,14 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Product image thumbnails/WebP copies are rendered in a process pool of
+# this size; set IMAGE_DERIVATIVES_ASYNC=False to render inline instead.
+IMAGE_DERIVATIVES_ASYNC = os.getenv('IMAGE_DERIVATIVES_ASYNC', 'True').lower() in ('1', 'true', 'yes')
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', 2))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -128,9 +213,38 @@ AUTH_USER_MODEL = 'shop.CustomUser'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'shop.authentication.CachedJWTAuthentication',
     ),
 }
 
+# CachedJWTAuthentication: verified tokens kept per process, and seconds a
+# user stays cached (saves and deletes invalidate it immediately)
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 10000))
+AUTH_USER_CACHE_TIMEOUT = int(os.getenv('AUTH_USER_CACHE_TIMEOUT', 60))
+
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
-STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
\ No newline at end of file
+STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
+STRIPE_ENDPOINT_SECRET = os.getenv("STRIPE_ENDPOINT_SECRET")  # from Stripe dashboard
+# Point at `manage.py run_payment_stub` to run without Stripe
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "https://api.stripe.com")
+
+# Payment gateway (shop.payments): the class to use, and for Stripe the
+# per-request timeout in seconds, network retries and pooled connections
+PAYMENT_GATEWAY = os.getenv("PAYMENT_GATEWAY", "shop.payments.StripeGateway")
+PAYMENT_TIMEOUT = float(os.getenv("PAYMENT_TIMEOUT", 10))
+PAYMENT_MAX_RETRIES = int(os.getenv("PAYMENT_MAX_RETRIES", 2))
+PAYMENT_POOL_SIZE = int(os.getenv("PAYMENT_POOL_SIZE", 10))
+
+# shop.maintenance: how long carts and pending orders may sit untouched
+# before `manage.py sweep_abandoned` expires them, rows per batch, and rows
+# removed per second at most (0 = no limit)
+CART_RETENTION_DAYS = int(os.getenv('CART_RETENTION_DAYS', 30))
+PENDING_ORDER_RETENTION_HOURS = int(os.getenv('PENDING_ORDER_RETENTION_HOURS', 48))
+MAINTENANCE_BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', 500))
+MAINTENANCE_MAX_RATE = float(os.getenv('MAINTENANCE_MAX_RATE', 2000))
+
+# shop.recommendations: related products kept per product, and seconds of
+# the most recent order history each `manage.py build_recommendations`
+# leaves for the next run (so late-committing writes aren't skipped)
+RECOMMENDATIONS_PER_PRODUCT = int(os.getenv('RECOMMENDATIONS_PER_PRODUCT', 10))
+RECOMMENDATION_LAG = int(os.getenv('RECOMMENDATION_LAG', 60))
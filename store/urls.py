@@ -14,22 +14,34 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path
 from shop.views import CreateStripePaymentIntent
 from shop.views import (
     RegisterView, 
     UserListView, 
+    InstrumentationMetricsView,
+    SalesReportView,
     ProductListCreateView, 
     ProductDetailView, 
+    ProductRelatedView,
+    ProductAvailabilityView,
+    ProductSearchView,
     CartDetailView,
     CartItemCreateView,
-    CartDetailView,
+    CartItemBulkCreateView,
+    CartItemDetailView,
+    CartSummaryView,
     OrderItemCreateView,
+    CheckoutView,
     OrderListView,
+    OrderExportView,
     OrderDetailView,
     stripe_webhook,
 )
+from shop import async_views
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -41,15 +53,33 @@ urlpatterns = [
     path('api/login/', TokenObtainPairView.as_view(), name='login'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/users/', UserListView.as_view(), name='users'), #locked endpoint
+    path('api/admin/metrics/', InstrumentationMetricsView.as_view(), name='metrics'), #locked endpoint
+    path('api/admin/reports/sales/', SalesReportView.as_view(), name='sales_report'), #locked endpoint
     path('api/products/', ProductListCreateView.as_view(), name='products'), #locked post endpoint
+    path('api/products/search/', ProductSearchView.as_view(), name='product_search'),
     path('api/products/<pk>/', ProductDetailView.as_view(), name='product_detail'), #locked put, patch, delelet endpoint
+    path('api/products/<int:pk>/related/', ProductRelatedView.as_view(), name='product_related'),
+    path('api/products/<int:pk>/availability/', ProductAvailabilityView.as_view(), name='product_availability'),
     path('api/cart/',  CartDetailView.as_view(), name='cart_detail'),
     path('api/cart/add/',  CartItemCreateView.as_view(), name='add_item'),
-    path('api/cart/update/<pk>/', CartDetailView.as_view(), name='update_item'),
+    path('api/cart/add-many/',  CartItemBulkCreateView.as_view(), name='add_items'),
+    path('api/cart/summary/', CartSummaryView.as_view(), name='cart_summary'),
+    path('api/cart/update/<pk>/', CartItemDetailView.as_view(), name='update_item'),
     path('api/order/', OrderItemCreateView.as_view(), name='make_order'),
+    path('api/checkout/', CheckoutView.as_view(), name='checkout'),
     path('api/orders/', OrderListView.as_view(), name="orders"),
+    path('api/orders/export/', OrderExportView.as_view(), name='order_export'),
     path('api/orders/<pk>/', OrderDetailView.as_view(), name='order_detail'),
     path("api/make-payment/", CreateStripePaymentIntent.as_view(), name="create-payment-intent"),
-    path('stripe/webhook/', stripe_webhook, name='stripe-webhook')
+    path('stripe/webhook/', stripe_webhook, name='stripe-webhook'),
+    # Async (ASGI) versions of the cart, order and payment endpoints
+    path('api/async/cart/', async_views.cart_detail, name='async_cart_detail'),
+    path('api/async/cart/add/', async_views.cart_add, name='async_add_item'),
+    path('api/async/checkout/', async_views.checkout_order, name='async_checkout'),
+    path('api/async/orders/', async_views.order_list, name='async_orders'),
+    path('api/async/orders/<int:pk>/', async_views.order_detail, name='async_order_detail'),
+    path('api/async/make-payment/', async_views.create_payment_intent, name='async_create_payment_intent'),
 ]
 
+if settings.DEBUG:
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)